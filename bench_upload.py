@@ -0,0 +1,103 @@
+"""
+Upload throughput of the old single `cat` stream against the framed mmap upload path.
+Runs through LocalHost by default, so no ssh server is needed and the result shows controller-side cost.
+With `ssh_host` ([user@]host[:port], key auth) files are uploaded over ssh into a remote temporary dir;
+for a latency run against localhost add delay first, e.g. `tc qdisc add dev lo root netem delay 20ms`.
+
+usage: python bench_upload.py [size_mb] [streams] [ssh_host]
+"""
+import resource
+import sys
+from asyncio import run
+from os import urandom, remove
+from os.path import getsize
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import aiofiles
+
+from env import Env
+from host import LocalHost, SSHHost
+from loader import ObjectLoader
+from task_manager import Task
+from transfer import TransferProgress
+
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def upload_cat(env: Env, src: str, dst: str, size: int):
+    host = await env.get_host()
+    process = await host.create_process(f'cat > "{dst}"')
+    fp_in = await aiofiles.open(src, mode='rb')
+    progress = TransferProgress(Task('cat', progress=True), size)
+    await env.upload_file_content(process, progress, fp_in, size)
+
+
+async def upload_framed(env: Env, src: str, dst: str, size: int, streams: int = 1):
+    progress = TransferProgress(Task('framed', progress=True), size)
+    await env.upload_file_streams(
+        src, dst, size, progress, streams, int(2 ** 22), sparse=False
+    )
+
+
+def _ssh_data(target: str, streams: int) -> dict:
+    data = dict(connections=streams)
+    if '@' in target:
+        data['username'], target = target.split('@', 1)
+    if ':' in target:
+        target, port = target.rsplit(':', 1)
+        data['port'] = int(port)
+    data['host'] = target
+    return data
+
+
+async def main(size_mb: int, streams: int, ssh_target: str = ''):
+    loader = ObjectLoader()
+    with TemporaryDirectory() as tmp_dir:
+        if ssh_target:
+            host = SSHHost('bench', loader, _ssh_data(ssh_target, streams))
+        else:
+            host = LocalHost('bench', loader, {})
+        loader._loaded['bench'] = host
+        await host.withstate('connected')
+        dst_dir = tmp_dir
+        if ssh_target:
+            dst_dir = (await host.run_command('mktemp -d')).strip()
+        env = Env('bench/env', loader, {'dir': dst_dir})
+        loader._loaded['bench/env'] = env
+
+        src = f'{tmp_dir}/src.img'
+        with open(src, 'wb') as f:
+            for _ in range(size_mb):
+                f.write(urandom(int(2 ** 20)))
+        size = getsize(src)
+
+        variants = (
+            ('cat, aiofiles 64 KiB', upload_cat(env, src, f'{dst_dir}/cat.img', size)),
+            ('framed mmap, 1 stream', upload_framed(env, src, f'{dst_dir}/framed1.img', size)),
+            (f'framed mmap, {streams} streams', upload_framed(env, src, f'{dst_dir}/framed.img', size, streams)),
+        )
+        print(f'{size_mb} MB to {ssh_target or "localhost, no ssh"}')
+        for name, coro in variants:
+            start_cpu = _cpu_seconds()
+            start = perf_counter()
+            await coro
+            elapsed = perf_counter() - start
+            cpu = _cpu_seconds() - start_cpu
+            print(
+                f'{name:28} {elapsed:7.2f} s {size / elapsed / 2 ** 20:9.1f} MB/s '
+                f'{cpu / (size / 2 ** 30):7.2f} cpu s/GB'
+            )
+        remove(src)
+        if ssh_target:
+            await host.run_command(f'rm -rf "{dst_dir}"')
+
+if __name__ == '__main__':
+    run(main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1024,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 4,
+        sys.argv[3] if len(sys.argv) > 3 else '',
+    ))
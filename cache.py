@@ -0,0 +1,47 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Iterable, Tuple, Any, Optional, Hashable
+
+
+class ResultCache:
+    """
+    LRU cache of command results with a time to live,
+    entries are dropped when a command touching their path runs.
+    Keys are (command text, envs, kind), kind keeps results of single commands, batches and streams apart
+    """
+
+    def __init__(self, ttl: float = 30., max_size: int = 256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: 'OrderedDict[Tuple[str, Hashable, str], Tuple[float, Any]]' = OrderedDict()
+
+    def get(self, key: Tuple[str, Hashable, str]) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Tuple[str, Hashable, str], value: Any):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        self._entries[key] = (monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, paths: Iterable[str]):
+        paths = [p for p in paths if p]
+        if not paths:
+            return
+        # key text is the command, so any command mentioning the path goes
+        for key in list(self._entries):
+            if any(p in key[0] for p in paths):
+                del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
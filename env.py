@@ -1,47 +1,38 @@
 import hashlib
 import re
-from asyncio import create_task, wait, FIRST_COMPLETED
-from os import SEEK_END
-from os.path import dirname
+from asyncio import gather, get_running_loop, ensure_future, Future, \
+    IncompleteReadError, sleep
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os import SEEK_END, O_RDONLY, O_WRONLY, O_CREAT, open as os_open, close as os_close, pwrite, ftruncate, rename, remove
+from os.path import dirname, exists
+from mmap import mmap, ACCESS_READ, MADV_SEQUENTIAL
 from time import perf_counter
-from typing import Tuple, Optional, Iterable, AnyStr
+from typing import Tuple, Optional, Iterable, AnyStr, List, Deque
 
 import aiofiles
 from aiofiles.threadpool.binary import AsyncBufferedReader
-from asyncssh import SSHClientProcess
+from asyncssh import SSHClientProcess, Error as SSHError
 
-from gui import ConfigObject, StrField, PassField, StateChange, decode_data
-from session import CommandError
+from gui import ConfigObject, StrField, PassField, IntField, SelectField, EnField, StateChange, decode_data
+from host import SSHHost
+from output import ProcessOutput, OutputBuffer
+from session import CommandError, CommandResult
+from store import local_digest
 from task_manager import Task, run_task
-
-
-def _format_speed(bps: float):
-    if bps < 1024.:
-        return f'{bps:.1f} B/s'
-    bps /= 1024.
-    if bps < 1024.:
-        return f'{bps:.1f} KB/s'
-    bps /= 1024.
-    return f'{bps:.1f} MB/s'
-
-
-def _format_seconds(secs: float):
-    secs = int(secs)
-    tm = f'{secs % 60:02}s'
-    secs //= 60
-    if not secs:
-        return tm
-    tm = f'{secs % 60:02}:' + tm
-    secs //= 60
-    if not secs:
-        return tm
-    tm = f'{secs}:' + tm
-    return tm
+from transfer import TransferProgress, data_extents, split_extents, frame_header, remote_writer_cmd, \
+    remote_allocate_cmd, remote_resize_cmd, remote_block_hashes_cmd, block_hash, blocks_to_extents, \
+    AdaptiveCompressor, CODECS, ChunkSizer, read_frames, remote_read_cmd, \
+    remote_range_digest_cmd, remote_source_cmd, remote_sink_cmd, remote_size_cmd, remote_digest_cmd, read_resume_log
 
 
 class Env(ConfigObject):
     dir: str = StrField(default='~/')
     key: str = PassField(default='')
+    upload_streams: int = IntField(default=1)
+    upload_chunk_kb: int = IntField(default=4096)
+    upload_compression: str = SelectField(values=('none', 'gzip', 'xz'))
+    upload_dedup: bool = EnField(default=False)
 
     environment: Tuple[Tuple[str, str], ...] = ()
     _full_dir = None
@@ -61,66 +52,50 @@ class Env(ConfigObject):
         host = await self.get_host()
         return await host.run_command(*a, envs=self.environment, **k)
 
-    async def monitor_process(self, process: SSHClientProcess, task: Task):
+    async def run_batch(self, *a, **k):
+        host = await self.get_host()
+        return await host.run_batch(*a, envs=self.environment, **k)
+
+    async def monitor_process(self, output: ProcessOutput, task: Task):
+        output.on_data = lambda o: task.set_message(o.last_line)
         try:
-            while True:
-                done, pending = await wait((
-                    create_task(process.stdout.read()),
-                    create_task(process.stderr.read()),
-                ), return_when=FIRST_COMPLETED)
-                if len(done):
-                    data_line = await done.pop()
-                    task.set_message(decode_data(data_line))
-                for p in pending:
-                    p.cancel()
+            exit_code = await output.run()
+            task.set_message(f'Exited with code {exit_code}: {output.last_line}')
         finally:
-            process.terminate()
+            output.on_data = None
 
     async def start_process(
             self, cmd: str, input: Optional[AnyStr] = None,
-            envs: Iterable[Tuple[str, str]] = ()
-    ):
+            envs: Iterable[Tuple[str, str]] = (), buffer: Optional[OutputBuffer] = None
+    ) -> ProcessOutput:
+        """
+        Run process in background task
+        :return: output collected until process exits, queryable while it runs
+        """
         host = await self.get_host()
-        process = await (await host.withstate('connected')).session.create_process(
-            cmd, input=input, env=envs
-        )
+        process = await host.create_process(cmd, input=input, env=envs)
+        output = ProcessOutput(process, buffer)
         task = Task(cmd)
-        run_task(self.monitor_process(process, task), task)
+        run_task(self.monitor_process(output, task), task)
+        return output
 
     async def upload_file_content(
-            self, process: SSHClientProcess, task: Task,
+            self, process: SSHClientProcess, progress: TransferProgress,
             fp_in: AsyncBufferedReader, upload_count: int,
             chunk_size=int(2 ** 16)
     ):
-        start_time = perf_counter()
-        start_upload_count = upload_count
-        last_meas = perf_counter()
-        last_upload_count = upload_count
-
         try:
             stdin = process.stdin
 
             while upload_count:
                 data = await fp_in.read(min(upload_count, chunk_size))
                 await stdin.drain()
-                task.set_progress(1. - upload_count / start_upload_count)
-                new_meas = perf_counter()
-                if new_meas - last_meas > 20.:
-                    current_speed = (last_upload_count - upload_count) / (new_meas - last_meas)
-                    overall_speed = (start_upload_count - upload_count) / (new_meas - start_time)
-                    task.set_message(
-                        f'Current speed: {_format_speed(current_speed)}'
-                        f'({_format_seconds(upload_count / current_speed)} elapsed) '
-                        f'Overall speed: {_format_speed(overall_speed)}'
-                        f'({_format_seconds(upload_count / overall_speed)} elapsed)'
-                    )
-                    last_meas = new_meas
-                    last_upload_count = upload_count
                 upload_count -= len(data)
                 stdin.write(data)
+                progress.add(len(data))
             stdin.write_eof()
             await stdin.drain()
-            task.set_progress(1.)
+            progress.finish()
         except BrokenPipeError:
             print('Connection failed')
         finally:
@@ -136,23 +111,470 @@ class Env(ConfigObject):
                 decode_data(await process.stdout.read()),
             )
 
-    async def upload_file(self, local_fname: str, dst_fname: str):
+    async def _upload_extents(
+            self, local_fname: str, dst_path: str, extents: List[Tuple[int, int]],
+            progress: TransferProgress, chunk_size: int, skip_zeros: bool = True,
+            compressor: Optional[AdaptiveCompressor] = None
+    ):
+        host = await self.get_host()
+        cmd = remote_writer_cmd(dst_path)
+        if not extents:
+            return
+        process = await host.create_process(cmd, env=self.environment)
+        # file is mapped and sent in slices without reads into new buffers or executor hops per chunk,
+        # ssh channels still copy every write into their send buffer
+        with open(local_fname, 'rb') as f:
+            mapped = mmap(f.fileno(), 0, access=ACCESS_READ)
+        mapped.madvise(MADV_SEQUENTIAL)
+        view = memoryview(mapped)
+        stdin = process.stdin
+        sizer = ChunkSizer(chunk_size)
+        # frames are compressed in workers while earlier ones are sent
+        pending: Deque[Tuple[int, int, Future]] = deque()
+        depth = compressor.workers + 1 if compressor is not None else 1
+
+        async def send_frame():
+            offset, read_count, encoded = pending.popleft()
+            codec, payload = await encoded
+            if payload:
+                stdin.write(frame_header(offset, len(payload), codec))
+                stdin.write(payload)
+                start = perf_counter()
+                await stdin.drain()
+                drain_time = perf_counter() - start
+                sizer.observe_drain(drain_time, process.channel.get_write_buffer_size())
+                if compressor is not None:
+                    compressor.observe_send(len(payload), drain_time)
+            progress.add(read_count)
+
+        try:
+            for offset, data, read_count in read_frames(view, extents, sizer, skip_zeros):
+                if compressor is not None and data:
+                    encoded = ensure_future(compressor.encode(data))
+                else:
+                    encoded = get_running_loop().create_future()
+                    encoded.set_result(('raw', data))
+                pending.append((offset, read_count, encoded))
+                if len(pending) >= depth:
+                    await send_frame()
+            while pending:
+                await send_frame()
+            stdin.write_eof()
+            stderr = await process.stderr.read()
+            completed = await process.wait()
+        finally:
+            for _, _, encoded in pending:
+                encoded.cancel()
+            process.close()
+            pending.clear()
+            view.release()
+            try:
+                mapped.close()
+            except BufferError:
+                # slices still referenced by write buffers, closed when collected
+                pass
+        CommandResult(cmd, completed.returncode, b'', stderr).check()
+
+    async def upload_file_streams(
+            self, local_fname: str, dst_path: str, upload_size: int,
+            progress: TransferProgress, streams: int, chunk_size: int,
+            sparse: bool = True, compressor: Optional[AdaptiveCompressor] = None
+    ):
+        if sparse:
+            with open(local_fname, 'rb') as f:
+                extents = data_extents(f.fileno(), upload_size)
+        else:
+            extents = [(0, upload_size)] if upload_size else []
+        progress.total = sum(count for _, count in extents)
+
+        # preallocated file is all holes, every stream writes its own extents
+        await self.run_command(
+            remote_allocate_cmd(dst_path, upload_size), invalidates=(dst_path,)
+        )
+        await gather(*(
+            self._upload_extents(
+                local_fname, dst_path, group, progress, chunk_size, compressor=compressor
+            )
+            for group in split_extents(extents, streams, chunk_size)
+        ))
+        progress.finish()
+
+    async def _changed_blocks(
+            self, local_fname: str, dst_path: str, upload_size: int, block_size: int
+    ) -> Tuple[int, List[int]]:
+        host = await self.get_host()
+        loop = get_running_loop()
+        fd = os_open(local_fname, O_RDONLY)
+        executor = ThreadPoolExecutor()
+        try:
+            local_hashes = [
+                loop.run_in_executor(executor, block_hash, fd, offset, block_size)
+                for offset in range(0, upload_size, block_size)
+            ]
+            remote_size = -1
+            same = set()
+            # remote hashes are compared as they come
+            async for line in host.stream_command(
+                    remote_block_hashes_cmd(dst_path, block_size),
+                    envs=self.environment, lines=True
+            ):
+                key, value = line.decode('ascii').split()
+                if key == 'size':
+                    remote_size = int(value)
+                    continue
+                i = int(key)
+                if i < len(local_hashes) and await local_hashes[i] == value:
+                    same.add(i)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            os_close(fd)
+        return remote_size, [i for i in range(len(local_hashes)) if i not in same]
+
+    async def upload_file_delta(
+            self, local_fname: str, dst_path: str, upload_size: int,
+            progress: TransferProgress, streams: int, chunk_size: int,
+            block_size: int = int(2 ** 22), compressor: Optional[AdaptiveCompressor] = None
+    ):
+        progress.set_message('Comparing blocks')
+        remote_size, changed = await self._changed_blocks(
+            local_fname, dst_path, upload_size, block_size
+        )
+        if remote_size == upload_size and not changed:
+            progress.set_message('Up to date')
+            progress.finish()
+            return
+        if remote_size < 0:
+            # nothing to patch, plain sparse upload
+            await self.upload_file_streams(
+                local_fname, dst_path, upload_size, progress, streams, chunk_size,
+                compressor=compressor
+            )
+            return
+
+        extents = blocks_to_extents(changed, block_size, upload_size)
+        progress.total = sum(count for _, count in extents)
+        progress.set_message(f'Sending {len(changed)} changed blocks')
+        await self.run_command(
+            remote_resize_cmd(dst_path, upload_size), invalidates=(dst_path,)
+        )
+        await gather(*(
+            self._upload_extents(
+                local_fname, dst_path, group, progress, chunk_size,
+                skip_zeros=False, compressor=compressor
+            )
+            for group in split_extents(extents, streams, chunk_size)
+        ))
+        progress.finish()
+
+    async def upload_file_dedup(
+            self, local_fname: str, dst_path: str, upload_size: int,
+            progress: TransferProgress, streams: int, chunk_size: int,
+            compressor: Optional[AdaptiveCompressor] = None
+    ):
+        progress.set_message('Hashing')
+        digest = await local_digest(local_fname)
+        host = await self.get_host()
+        store = host.store
+        if await store.link_into(digest, dst_path):
+            progress.set_message(f'Linked from store {digest[:12]}')
+            progress.finish()
+            return
+
+        await store.prepare(digest)
+        tmp_path = store.tmp_path(digest)
+        await self.upload_file_streams(
+            local_fname, tmp_path, upload_size, progress, streams, chunk_size,
+            compressor=compressor
+        )
+        await store.add(tmp_path, digest)
+        if not await store.link_into(digest, dst_path):
+            raise CommandError(f'Blob {digest} missing in store right after upload')
+        await store.evict()
+
+    async def upload_file(
+            self, local_fname: str, dst_fname: str,
+            streams: Optional[int] = None, chunk_size: Optional[int] = None,
+            sparse: bool = True, delta: bool = False, compression: Optional[str] = None,
+            dedup: Optional[bool] = None
+    ):
+        """
+        Upload in background task
+        :param streams: number of parallel channels, `upload_streams` by default
+        :param chunk_size: bytes read and sent at once, `upload_chunk_kb` by default
+        :param sparse: send only data, holes and zero blocks are recreated as holes
+        :param delta: patch existing remote file, send only blocks with different hash
+        :param compression: codec compressing chunks while it pays off, `upload_compression` by default
+        :param dedup: go through host content store, `upload_dedup` by default,
+            refused unless host store is on encrypted storage
+        """
         await self.ensure_file_path(dst_fname)
+        streams = streams or self.upload_streams
+        chunk_size = chunk_size or self.upload_chunk_kb * 1024
+        compression = compression or self.upload_compression
+        compressor = AdaptiveCompressor(CODECS[compression]) if compression != 'none' else None
+        dedup = self.upload_dedup if dedup is None else dedup
+        if dedup:
+            host = await self.get_host()
+            if not host.store_encrypted:
+                raise ValueError(
+                    f'Dedup upload into encrypted env would keep plaintext copy in {host.store_dir}, '
+                    f'enable store_encrypted on {host._current_path} once it is on encrypted storage'
+                )
+        dst_path = self.format_path(dst_fname)
 
         fp_in = await aiofiles.open(local_fname, mode='rb')
         await fp_in.seek(0, SEEK_END)
         upload_size = await fp_in.tell()
         await fp_in.seek(0)
 
-        cmd = f'cat > "{self.format_path(dst_fname)}"'
+        task = Task(f'{local_fname} -> {dst_fname}', progress=True)
+        progress = TransferProgress(task, upload_size)
+        if dedup:
+            await fp_in.close()
+            run_task(self.upload_file_dedup(
+                local_fname, dst_path, upload_size, progress, streams, chunk_size,
+                compressor=compressor
+            ), task)
+            return
+        if delta:
+            await fp_in.close()
+            run_task(self.upload_file_delta(
+                local_fname, dst_path, upload_size, progress, streams, chunk_size,
+                compressor=compressor
+            ), task)
+            return
+        if streams > 1 or sparse or compressor is not None:
+            await fp_in.close()
+            run_task(self.upload_file_streams(
+                local_fname, dst_path, upload_size, progress, streams, chunk_size, sparse,
+                compressor=compressor
+            ), task)
+            return
+
+        cmd = f'cat > "{dst_path}"'
         host = await self.get_host()
-        process = await (await host.withstate('connected')).session.create_process(
-            cmd, env=self.environment
-        )
+        host.invalidate((dst_path,))
+        process = await host.create_process(cmd, env=self.environment)
 
-        task = Task(f'{local_fname} -> {dst_fname}', progress=True)
         run_task(self.upload_file_content(
-            process, task, fp_in, upload_size
+            process, progress, fp_in, upload_size, chunk_size
+        ), task)
+
+    async def _download_range(
+            self, src_path: str, fd: int, offset: int, count: int,
+            progress: TransferProgress, retry_count: int
+    ) -> str:
+        """
+        Stream range into local file, resuming from reached offset after connection errors
+        :return: sha256 of received data
+        """
+        host = await self.get_host()
+        h = hashlib.sha256()
+        end = offset + count
+        while offset < end:
+            try:
+                async for data in host.stream_command(
+                        remote_read_cmd(src_path, offset, end - offset), envs=self.environment
+                ):
+                    pwrite(fd, data, offset)
+                    h.update(data)
+                    offset += len(data)
+                    progress.add(len(data))
+            except (OSError, IncompleteReadError, SSHError) as e:
+                if retry_count <= 0:
+                    raise
+                retry_count -= 1
+                print(f'Download of {src_path} interrupted at {offset}, resuming', e)
+                await sleep(1.)
+                continue
+            if offset < end:
+                raise EOFError(f'{src_path} truncated during download')
+        return h.hexdigest()
+
+    async def _verify_range(
+            self, src_path: str, offset: int, count: int, digest
+    ):
+        remote_digest, digest = await gather(
+            self.run_command(remote_range_digest_cmd(src_path, offset, count)),
+            digest,
+        )
+        if remote_digest.strip() != digest:
+            raise CommandError(
+                f'Checksum mismatch of {src_path} bytes {offset}-{offset + count}'
+            )
+
+    async def download_file_streams(
+            self, src_path: str, local_fname: str, size: int,
+            progress: TransferProgress, streams: int, verify: bool = True,
+            retry_count: int = 3, source_id: str = '', block_size: int = int(2 ** 26)
+    ):
+        """
+        :param source_id: changes with source file, blocks of earlier partial download are kept while it is the same
+        """
+        part_fname = f'{local_fname}.part'
+        log_fname = f'{part_fname}.log'
+        source_id = source_id or str(size)
+        done = read_resume_log(log_fname, source_id) if exists(part_fname) else {}
+        blocks = [
+            (offset, min(block_size, size - offset)) for offset in range(0, size, block_size)
+            if done.get(offset, (0, ''))[0] != min(block_size, size - offset)
+        ]
+        progress.done = size - sum(count for _, count in blocks)
+        if progress.done:
+            progress.set_message(f'Resuming, {progress.done} bytes downloaded before')
+
+        fd = os_open(part_fname, O_WRONLY | O_CREAT, 0o644)
+        log = open(log_fname, 'a' if done else 'w')
+        pending = iter(blocks)
+
+        async def download_blocks():
+            for offset, count in pending:
+                digest = ensure_future(self._download_range(
+                    src_path, fd, offset, count, progress, retry_count
+                ))
+                if verify:
+                    await self._verify_range(src_path, offset, count, digest)
+                # block is logged only after it is complete
+                log.write(f'{offset} {count} {await digest}\n')
+                log.flush()
+
+        workers = []
+        try:
+            ftruncate(fd, size)
+            if not done:
+                log.write(f'{source_id}\n')
+                log.flush()
+            workers = [ensure_future(download_blocks()) for _ in range(max(streams, 1))]
+            await gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            os_close(fd)
+            log.close()
+        rename(part_fname, local_fname)
+        remove(log_fname)
+        progress.finish()
+
+    async def download_file(
+            self, src_fname: str, local_fname: str,
+            streams: Optional[int] = None, verify: bool = True
+    ):
+        """
+        Download in background task, completed blocks of partial `.part` file are resumed
+        :param streams: number of parallel channels, `upload_streams` by default
+        :param verify: compare sha256 of every received block with remote one
+        """
+        streams = streams or self.upload_streams
+        src_path = self.format_path(src_fname)
+        # size and modification time
+        source_id = (await self.run_command(f'stat -c "%s %Y" "{src_path}"')).strip()
+        size = int(source_id.split(' ')[0])
+
+        task = Task(f'{src_fname} -> {local_fname}', progress=True)
+        progress = TransferProgress(task, size)
+        run_task(self.download_file_streams(
+            src_path, local_fname, size, progress, streams, verify, source_id=source_id
+        ), task)
+
+    async def _poll_size(self, path: str, progress: TransferProgress, interval: float = 1.):
+        while True:
+            size = int((await self.run_command(remote_size_cmd(path))).strip())
+            if size > progress.done:
+                progress.add(size - progress.done)
+            await sleep(interval)
+
+    async def _relay(
+            self, other: 'Env', src_cmd: str, dst_cmd: str,
+            progress: Optional[TransferProgress], chunk_size: int = int(2 ** 18)
+    ):
+        src = await (await self.get_host()).create_process(src_cmd, env=self.environment)
+        dst = await (await other.get_host()).create_process(dst_cmd, env=other.environment)
+        try:
+            stdout = src.stdout
+            stdin = dst.stdin
+            # chunks are handed over as read, flow is limited only by destination drain
+            while True:
+                data = await stdout.read(chunk_size)
+                if not data:
+                    break
+                stdin.write(data)
+                await stdin.drain()
+                if progress is not None:
+                    progress.add(len(data))
+            stdin.write_eof()
+            src_err, dst_err = await gather(src.stderr.read(), dst.stderr.read())
+            src_done, dst_done = await gather(src.wait(), dst.wait())
+        finally:
+            src.close()
+            dst.close()
+        CommandResult(src_cmd, src_done.returncode, b'', src_err).check()
+        CommandResult(dst_cmd, dst_done.returncode, b'', dst_err).check()
+
+    async def transfer_file(
+            self, other: 'Env', src_path: str, dst_path: str, size: int,
+            progress: TransferProgress, direct: bool = False, sparse: bool = True,
+            codec: Optional[str] = None, verify: bool = False
+    ):
+        src_cmd = remote_source_cmd(src_path, codec)
+        dst_cmd = remote_sink_cmd(dst_path, size, codec, sparse)
+        other_host = await other.get_host()
+        other_host.invalidate((dst_path,))
+        # compressed byte count does not match file offsets, destination size is watched instead
+        poll = None
+        if direct or codec:
+            poll = ensure_future(other._poll_size(dst_path, progress))
+        try:
+            if direct:
+                if not isinstance(other_host, SSHHost):
+                    raise ValueError(f'Direct transfer needs ssh destination, got {other_host.__class__.__name__}')
+                # pipeline exits with status of ssh, status of source comes out on fd 3
+                src_status = (await self.run_command(
+                    f'{{ {{ {src_cmd}; echo "$?" >&3; }} | {other_host.ssh_command(dst_cmd)}; }} 3>&1'
+                )).strip()
+                if src_status != '0':
+                    raise CommandError(
+                        f'Command `{src_cmd}` failed with code {src_status}; {dst_path} is incomplete'
+                    )
+            else:
+                await self._relay(other, src_cmd, dst_cmd, None if codec else progress)
+        finally:
+            if poll is not None:
+                poll.cancel()
+
+        if verify:
+            progress.set_message('Verifying')
+            src_digest, dst_digest = await gather(
+                self.run_command(remote_digest_cmd(src_path)),
+                other.run_command(remote_digest_cmd(dst_path)),
+            )
+            if src_digest.strip() != dst_digest.strip():
+                raise CommandError(f'Checksum mismatch after transfer of {src_path} to {dst_path}')
+        progress.finish()
+
+    async def transfer_to(
+            self, other: 'Env', src_fname: str, dst_fname: Optional[str] = None,
+            direct: bool = False, sparse: bool = True, compression: Optional[str] = None,
+            verify: bool = False
+    ):
+        """
+        Copy file to other env in background task, data is not stored on this machine
+        :param direct: source host sends with ssh to destination, otherwise channels are relayed here
+        :param sparse: zero blocks are written as holes
+        :param compression: codec used on the wire, `upload_compression` by default
+        :param verify: compare sha256 of both files after transfer
+        """
+        dst_fname = dst_fname or src_fname
+        compression = compression or self.upload_compression
+        codec = compression if compression in CODECS else None
+        src_path = self.format_path(src_fname)
+        dst_path = other.format_path(dst_fname)
+        await other.ensure_file_path(dst_fname)
+        size = int((await self.run_command(f'stat -c %s "{src_path}"')).strip())
+
+        task = Task(f'{src_fname} -> {other._current_path}:{dst_fname}', progress=True)
+        progress = TransferProgress(task, size)
+        run_task(self.transfer_file(
+            other, src_path, dst_path, size, progress, direct, sparse, codec, verify
         ), task)
 
     def get_special_path(self, special_name) -> Optional[str]:
@@ -167,15 +589,17 @@ class Env(ConfigObject):
     async def ensure_path(self, local_dir):
         local_dir = self.format_path(local_dir)
         host = await self.get_host()
+        # existing dir is cached, only a miss creates it
         try:
-            await host.run_command(f'ls "{local_dir}"')
-            return (await host.run_command(f'realpath "{local_dir}"')).strip('\n')
-        except CommandError as e:
-            if ': No such file or directory\n' in str(e):
-                await host.run_command(f'mkdir -p "{local_dir}"')
-                return (await host.run_command(f'realpath "{local_dir}"')).strip('\n')
-            else:
-                raise
+            return (await host.run_command(f'realpath -e "{local_dir}"', idempotent=True)).strip('\n')
+        except CommandError:
+            pass
+        created, realpath = await host.run_batch((
+            f'mkdir -p "{local_dir}"',
+            f'realpath -e "{local_dir}"',
+        ), invalidates=(local_dir,))
+        created.check()
+        return realpath.check().strip('\n')
 
     async def ensure_file_path(self, fname):
         dir_name = dirname(fname)
@@ -207,7 +631,7 @@ class Env(ConfigObject):
                 f'&& mkdir -p "{self._full_dir}" && rmdir "{self._full_dir}" && mkdir -p "{self._full_dir}" '
                 f'&& fscrypt encrypt "{self._full_dir}" --quiet --source=raw_key --name=vm --key="$F"'
             ) + ' )',
-            input=key
+            input=key, invalidates=(self._full_dir,)
         )
 
     async def _decrypt(self, key: bytes):
@@ -219,7 +643,7 @@ class Env(ConfigObject):
                 f'&& ls "{self._full_dir}" '
                 f'&& fscrypt unlock "{self._full_dir}" --key="$F"'
             ) + ' )',
-            input=key
+            input=key, invalidates=(self._full_dir,)
         )
 
     @StateChange('loaded', 'unlocked')
@@ -240,4 +664,5 @@ class Env(ConfigObject):
         host = await self.get_host()
         await host.run_command(
             f'fscrypt lock --drop-caches=false "{self._full_dir}"',
+            invalidates=(self._full_dir,)
         )
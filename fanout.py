@@ -0,0 +1,84 @@
+from asyncio import Semaphore, wait_for, as_completed, ensure_future
+from typing import Iterable, Dict, NamedTuple, Optional, AsyncIterator
+
+from loader import ObjectLoader
+
+
+class HostResult(NamedTuple):
+    path: str
+    output: Optional[str]
+    error: Optional[BaseException]
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __str__(self):
+        if self.ok:
+            return f'{self.path}: ok'
+        return f'{self.path}: {self.error.__class__.__name__}: {self.error}'
+
+
+class FanOut:
+    """
+    Run one command on many hosts concurrently, results come in completion order
+    """
+
+    def __init__(
+            self, loader: ObjectLoader, host_paths: Iterable[str], cmd: str,
+            concurrency: int = 16, timeout: Optional[float] = 60.
+    ):
+        self._loader = loader
+        self._host_paths = tuple(host_paths)
+        self._cmd = cmd
+        self._concurrency = max(concurrency, 1)
+        self._timeout = timeout
+        self.results: Dict[str, HostResult] = {}
+
+    @property
+    def failures(self) -> Dict[str, BaseException]:
+        return {
+            path: res.error for path, res in self.results.items() if not res.ok
+        }
+
+    async def _run_host(self, path: str, semaphore: Semaphore) -> HostResult:
+        async with semaphore:
+            try:
+                host = self._loader.load('.', path)
+                # timeout covers connecting too
+                output = await wait_for(host.run_command(self._cmd), self._timeout)
+                res = HostResult(path, output, None)
+            except Exception as e:
+                res = HostResult(path, None, e)
+        self.results[path] = res
+        return res
+
+    async def run(self) -> AsyncIterator[HostResult]:
+        semaphore = Semaphore(self._concurrency)
+        tasks = [
+            ensure_future(self._run_host(path, semaphore))
+            for path in self._host_paths
+        ]
+        try:
+            for next_done in as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def run_messages(self) -> AsyncIterator[str]:
+        """
+        Progress messages for `run_task`
+        """
+        async for res in self.run():
+            yield f'{len(self.results)}/{len(self._host_paths)} {res}'
+        yield self.report()
+
+    def report(self) -> str:
+        failures = self.failures
+        report = f'{len(self.results) - len(failures)}/{len(self._host_paths)} hosts ok'
+        if failures:
+            report += '; failed: ' + '; '.join(
+                str(self.results[path]) for path in sorted(failures)
+            )
+        return report
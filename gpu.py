@@ -1,27 +1,207 @@
+from asyncio import Lock
+from math import nan
+from os.path import isdir, exists
+from time import time
+from typing import Optional, Dict, Set, AsyncIterator, List
+
 from lxml import etree as ET
 
-from gui import ConfigObject, FloatField, StrField
+from gui import ConfigObject, FloatField, StrField, IntField
+from metrics import TimeSeries
+from task_manager import Task, run_task
+
+GPU_FIELDS = ('utilization', 'memory_used_mb', 'temperature', 'power_w')
+
+# name is last, it is the only value that may contain separator
+_QUERY_FIELDS = (
+    'pci.bus_id', 'memory.total', 'utilization.gpu', 'memory.used',
+    'temperature.gpu', 'power.draw', 'name',
+)
+
+
+def _parse_number(v: str) -> float:
+    try:
+        return float(v)
+    except ValueError:
+        # [N/A], [Not Supported]
+        return nan
+
+
+def sysfs_pci_id(bus_id: str) -> str:
+    """
+    nvidia-smi bus id `00000000:05:00.0` as `0000:05:00.0`
+    """
+    domain, _, rest = bus_id.partition(':')
+    return f'{domain[-4:].lower()}:{rest.lower()}'
+
+
+def vfio_bind_cmd(bus_id: str) -> str:
+    dev = f'/sys/bus/pci/devices/{sysfs_pci_id(bus_id)}'
+    return (
+        f'echo vfio-pci > {dev}/driver_override && '
+        f'( [ ! -e {dev}/driver ] || echo {sysfs_pci_id(bus_id)} > {dev}/driver/unbind ) && '
+        f'echo {sysfs_pci_id(bus_id)} > /sys/bus/pci/drivers_probe'
+    )
 
 
 class GPU(ConfigObject):
     name = StrField(default='')
     model = StrField(default='')
     ram_mb = FloatField(default=0)
+    claimed_by = StrField(default='')
+
+    telemetry: Optional[TimeSeries] = None
 
 
 class GPUS(ConfigObject):
-    properties: str = None
+    telemetry_interval_ms: int = IntField(default=1000)
+    telemetry_capacity: int = IntField(default=3600)
 
-    async def detect_gpus(self):
-        host = await self.get_host()
-        xml_gpus = await host.run_command('nvidia-smi -q -x')
-        self.properties = xml_gpus
+    def __init__(self, current_path: str, loader: 'ObjectLoader', data):
+        super().__init__(current_path, loader, data)
+        self.present: Set[str] = set()
+        self._allocation_lock = Lock()
 
-        root = ET.fromstring(xml_gpus)
-        for gpu in root.xpath('/nvidia_smi_log/gpu'):
+    def gpus(self) -> List[GPU]:
+        """
+        Detected and saved gpus of host
+        """
+        if isdir(self._current_path):
+            for _ in self._loader.load_dir(self._current_path):
+                pass
+        prefix = f'{self._current_path}/'
+        return [
+            o for p, o in self._loader._loaded.items()
+            if p.startswith(prefix) and '/' not in p[len(prefix):] and isinstance(o, GPU)
+        ]
+
+    async def allocate(self, owner: str, count: int, min_ram_mb: float = 0.) -> List[GPU]:
+        """
+        Claim gpus for `owner`, smallest sufficient ones first to keep big gpus free.
+        Gpus already claimed by `owner` are reused. Claims are saved before return.
+        """
+        async with self._allocation_lock:
+            gpus = self.gpus()
+            if not gpus:
+                await self.detect_gpus()
+                gpus = self.gpus()
+            claimed = sorted(
+                (gpu for gpu in gpus if gpu.claimed_by == owner), key=lambda gpu: gpu.name
+            )
+            free = sorted(
+                (gpu for gpu in gpus if not gpu.claimed_by and gpu.ram_mb >= min_ram_mb),
+                key=lambda gpu: (gpu.ram_mb, gpu.name)
+            )
+            missing = count - len(claimed)
+            if missing > len(free):
+                raise ValueError(
+                    f'{self._current_path}: {missing} gpus with {min_ram_mb} MB needed, {len(free)} free'
+                )
+            for gpu in free[:max(missing, 0)]:
+                gpu.claimed_by = owner
+                claimed.append(gpu)
+            self._loader.save_all()
+            return claimed[:count]
+
+    async def release(self, owner: str):
+        async with self._allocation_lock:
+            released = False
+            for gpu in self.gpus():
+                if gpu.claimed_by == owner:
+                    gpu.claimed_by = ''
+                    released = True
+            if released:
+                self._loader.save_all()
+
+    def _register_gpu(self, name: str, model: str, ram_mb: float) -> GPU:
+        path = f'{self._current_path}/{name}'
+        gpu_obj = self._loader._loaded.get(path)
+        if gpu_obj is None and exists(f'{path}.json'):
+            # saved claim must survive restart
+            gpu_obj = self._loader.load('.', path)
+        if gpu_obj is None:
             gpu_obj = GPU(self._current_path, self._loader, dict(
-                name=gpu.get('id'),
-                model=gpu.xpath('./product_name')[0].text,
-                ram_mb=float(gpu.xpath('./fb_memory_usage/total')[0].text.split(' ')[0]),
+                name=name, model=model, ram_mb=ram_mb,
             ))
-            self._loader._loaded[f'{self._current_path}/{gpu_obj.name}'] = gpu_obj
+            self._loader._loaded[path] = gpu_obj
+        else:
+            gpu_obj.model = model
+            gpu_obj.ram_mb = ram_mb
+        return gpu_obj
+
+    def _add_gpu(self, gpu):
+        self._register_gpu(
+            gpu.get('id'),
+            gpu.xpath('./product_name')[0].text,
+            float(gpu.xpath('./fb_memory_usage/total')[0].text.split(' ')[0]),
+        )
+
+    async def detect_gpus(self):
+        host = await self.get_host()
+        # gpus are parsed as soon as their element is complete
+        parser = ET.XMLPullParser(events=('end',), tag='gpu')
+        async for chunk in host.stream_command('nvidia-smi -q -x', idempotent=True):
+            parser.feed(chunk)
+            for _, gpu in parser.read_events():
+                parent = gpu.getparent()
+                if parent is None or parent.tag != 'nvidia_smi_log':
+                    continue
+                self._add_gpu(gpu)
+                gpu.clear()
+                while gpu.getprevious() is not None:
+                    del parent[0]
+        parser.close()
+
+    def _reconcile(self, rows: Dict[str, List[str]]):
+        for name in set(rows) - self.present:
+            row = rows[name]
+            gpu_obj = self._register_gpu(name, row[6], _parse_number(row[1]))
+            if gpu_obj.telemetry is None:
+                gpu_obj.telemetry = TimeSeries(GPU_FIELDS, self.telemetry_capacity)
+            print(f'{self._current_path}: gpu {name} appeared')
+        for name in self.present - set(rows):
+            print(f'{self._current_path}: gpu {name} disappeared')
+        self.present = set(rows)
+
+    def _record(self, t: float, rows: Dict[str, List[str]]):
+        if set(rows) != self.present:
+            self._reconcile(rows)
+        for name, row in rows.items():
+            gpu_obj = self._loader._loaded[f'{self._current_path}/{name}']
+            gpu_obj.telemetry.append(t, dict(zip(GPU_FIELDS, map(_parse_number, row[2:6]))))
+
+    def watch_telemetry(self):
+        """
+        Collect gpu telemetry in background task showing last sample
+        """
+        run_task(self.telemetry(), Task(f'{self._current_path} telemetry'))
+
+    async def telemetry(self) -> AsyncIterator[str]:
+        """
+        Follow one long running nvidia-smi, every sample is added to gpu time series
+        :return: summary of every sample for task message
+        """
+        host = await self.get_host()
+        cmd = (
+            f'nvidia-smi --query-gpu={",".join(_QUERY_FIELDS)} '
+            f'--format=csv,noheader,nounits -lms {self.telemetry_interval_ms}'
+        )
+        rows: Dict[str, List[str]] = {}
+        t = time()
+        async for line in host.stream_command(cmd, lines=True):
+            row = [v.strip() for v in line.decode('utf-8').split(',', len(_QUERY_FIELDS) - 1)]
+            if len(row) != len(_QUERY_FIELDS):
+                continue
+            # every sample lists all gpus, repeated bus id starts next one
+            if row[0] in rows:
+                self._record(t, rows)
+                yield ' | '.join(
+                    f'{name[-7:]}: {row[2]}% {row[3]}M {row[4]}C {row[5]}W'
+                    for name, row in sorted(rows.items())
+                )
+                rows = {}
+            if not rows:
+                t = time()
+            rows[row[0]] = row
+        if rows:
+            self._record(t, rows)
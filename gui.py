@@ -1,6 +1,7 @@
-from asyncio import sleep
+from asyncio import sleep, ensure_future, shield, gather, Future
+from collections import defaultdict, deque
 from functools import partial, wraps
-from typing import TYPE_CHECKING, Optional, TypeVar
+from typing import TYPE_CHECKING, Optional, TypeVar, Dict, List, Tuple
 
 import gi
 
@@ -12,7 +13,7 @@ from gi.repository import Gtk, Gdk, GObject  # noqa
 
 if TYPE_CHECKING:
     from env import Env
-    from host import SSHHost
+    from host import Host
     from loader import ObjectLoader
 
 T = TypeVar('T')
@@ -248,6 +249,7 @@ class ConfigObject:
         self._current_path = current_path
         self._loader: 'ObjectLoader' = loader
         self._state = 'loaded'
+        self._transition: Optional[Future] = None
         self.load_serialized(data)
 
     @classmethod
@@ -262,23 +264,31 @@ class ConfigObject:
                 to_visit.update(subcls.__subclasses__())
         return mapping
 
+    @classmethod
+    def fields(cls) -> Dict[str, Field]:
+        # base class fields first, so hosts can share common settings
+        fields = {}
+        for klass in reversed(cls.__mro__):
+            for k, v in vars(klass).items():
+                if isinstance(v, Field):
+                    fields[k] = v
+        return fields
+
     def load_serialized(self, data):
         cls = type(self)
-        for k in vars(cls).keys():
-            field_descr = getattr(cls, k, None)
-            if isinstance(field_descr, Field):
-                v = data.get(k)
-                if v is not None:
-                    try:
-                        self.__dict__[k] = field_descr.deserialize(v)
-                    except ValueError:
-                        # TODO: handle parse error
-                        pass
-                else:
-                    v = field_descr.default
-                    if v is None:
-                        raise ValueError(f'No default value for {k} in {cls.__name__}')
-                    self.__dict__[k] = v
+        for k, field_descr in cls.fields().items():
+            v = data.get(k)
+            if v is not None:
+                try:
+                    self.__dict__[k] = field_descr.deserialize(v)
+                except ValueError:
+                    # TODO: handle parse error
+                    pass
+            else:
+                v = field_descr.default
+                if v is None:
+                    raise ValueError(f'No default value for {k} in {cls.__name__}')
+                self.__dict__[k] = v
 
     def serialize(self):
         cls = type(self)
@@ -299,6 +309,7 @@ class ConfigObject:
             v = field_descr.parse_input(v)
             self.__dict__[name] = v
             field_descr.set_value(field_in, v)
+            self.validate()
             field_in.get_style_context().remove_class("error")
             # field_in.set_property('has-tooltip', False)
             remove_error_tooltip(field_in)
@@ -313,7 +324,7 @@ class ConfigObject:
         grid.attach(Gtk.Label(''), 0, 0, 2, 1)
         n = 1
 
-        for name, field_descr in vars(cls).items():
+        for name, field_descr in cls.fields().items():
             if isinstance(field_descr, Field):
                 descr_label = Gtk.Label(name)
                 err_label = Gtk.Label('')
@@ -348,32 +359,84 @@ class ConfigObject:
     def get_special_path(self, special_name) -> Optional[str]:
         return None
 
-    # TODO: analyze graph
+    @classmethod
+    def state_changes(cls) -> Dict[str, List[StateChange]]:
+        changes = defaultdict(list)
+        for klass in reversed(cls.__mro__):
+            for v in vars(klass).values():
+                if isinstance(v, StateChange):
+                    changes[v.state_from].append(v)
+        return changes
+
+    @classmethod
+    def plan_states(cls, f, t) -> Optional[List[StateChange]]:
+        """
+        Shortest chain of state changes from `f` to `t`
+        """
+        changes = cls.state_changes()
+        came_by: Dict[str, Optional[StateChange]] = {f: None}
+        to_visit = deque((f,))
+        while to_visit:
+            state = to_visit.popleft()
+            if state == t:
+                path = []
+                while came_by[state] is not None:
+                    path.append(came_by[state])
+                    state = came_by[state].state_from
+                return path[::-1]
+            for change in changes.get(state, ()):
+                if change.state_to not in came_by:
+                    came_by[change.state_to] = change
+                    to_visit.append(change.state_to)
+        return None
+
+    def validate(self):
+        """
+        Raise ValueError for invalid combination of field values
+        """
+
     async def _go_to_state(self, f, t):
         if f == t:
             return
 
-        print(f'{f} -> {t} ...')
+        path = self.plan_states(f, t)
+        if path is None:
+            raise ValueError(f'Could not move state {f} -> {t}')
 
-        for prop in vars(type(self)).values():
-            if isinstance(prop, StateChange) and prop.state_from == f and prop.state_to == t:
-                await prop.func(self)
-                return
-
-        raise ValueError(f'Could not move state {f} -> {t}')
+        for change in path:
+            print(f'{self._current_path}: {change.state_from} -> {change.state_to} ...')
+            await change.func(self)
+            self._state = change.state_to
 
     async def withstate(self: T, state) -> T:  # TODO: use with scope ?
-        await self._go_to_state(self._state, state)
-        self._state = state
+        # concurrent callers share one running transition
+        while self._state != state:
+            transition = self._transition
+            if transition is None:
+                transition = ensure_future(self._go_to_state(self._state, state))
+                self._transition = transition
+                transition.add_done_callback(self._transition_done)
+            await shield(transition)
         return self
 
-    async def get_host(self) -> 'SSHHost':
+    def _transition_done(self, transition: Future):
+        if self._transition is transition:
+            self._transition = None
+
+    async def get_host(self) -> 'Host':
         return await self.o('$host').withstate('connected')
 
     async def get_env(self) -> 'Env':
         return await self.o('$env').withstate('unlocked')
 
 
+async def withstates(*targets: Tuple[ConfigObject, str]) -> List[ConfigObject]:
+    """
+    Move independent objects to their states concurrently
+    """
+    return list(await gather(*(obj.withstate(state) for obj, state in targets)))
+
+
 class HierarchyView:
     def __init__(self, loader: 'ObjectLoader', base_path: str = '.'):
         self.loader = loader
@@ -1,11 +1,23 @@
-from asyncio import wait, FIRST_COMPLETED, create_task
-from os import getlogin
-from typing import Iterable, Tuple, Optional, AnyStr
+from asyncio import wait, FIRST_COMPLETED, create_task, gather, shield, ensure_future, get_running_loop, Future, \
+    Lock, Semaphore, wait_for, create_subprocess_shell, StreamReader, StreamWriter, \
+    open_unix_connection as asyncio_open_unix_connection
+from asyncio.subprocess import Process, PIPE
+from contextlib import asynccontextmanager
+from os import getlogin, environ
+from os.path import expanduser
+from shlex import quote
+from typing import Iterable, Tuple, Optional, AnyStr, Dict, Set, Callable, Awaitable, List, AsyncIterator
 
-from asyncssh import connect, SSHClientConnectionOptions, SSHClientConnection, ChannelOpenError, SSHClientProcess
+from asyncssh import connect, SSHClientConnectionOptions, SSHClientConnection, ChannelOpenError, SSHClientProcess, \
+    SSHReader, SSHWriter
 
-from gui import ConfigObject, EnField, StrField, IntField, StateChange, decode_data
-from session import CommandError, SessionProcess
+from cache import ResultCache
+from gui import ConfigObject, EnField, StrField, IntField, FloatField, StateChange
+from inventory import HostInventory
+from metrics import MetricsCollector
+from session import SessionProcess, CommandResult
+from shell import RemoteShell, ShellClosedError, frame_batch, split_batch
+from store import ContentStore
 from task_manager import Task, run_task
 
 global last_port
@@ -81,17 +93,355 @@ class SSHProcess(SessionProcess):
 #         self._ssh.close()
 
 
-class SSHHost(ConfigObject):
+def _is_connection_closed(e: ChannelOpenError) -> bool:
+    return 'SSH connection closed' in str(e)
+
+
+class SSHConnectionPool:
+    def __init__(
+            self, open_connection: Callable[[], Awaitable[SSHClientConnection]],
+            connection_count: int = 1, max_channels: int = 10, max_connections: int = 8
+    ):
+        """
+        :param max_channels: concurrent short commands of host and open channels per connection,
+            like sshd MaxSessions
+        :param max_connections: connections opened when long running processes fill the others,
+            they hold their channel and must not starve short commands
+        """
+        self._open_connection = open_connection
+        self._connection_count = max(connection_count, 1)
+        self._max_channels = max(max_channels, 1)
+        self._max_connections = max(max_connections, self._connection_count)
+        # short commands of whole host, long running processes only count per connection
+        self._channels = Semaphore(self._max_channels)
+        self._open_channels: Dict[SSHClientConnection, int] = {}
+        self._connect_task: Optional[Future] = None
+        self._freed: Optional[Future] = None
+        self._watchers: Set[Future] = set()
+
+    @property
+    def connections(self) -> Tuple[SSHClientConnection, ...]:
+        return tuple(self._open_channels)
+
+    async def _connect_missing(self, count: int):
+        missing = count - len(self._open_channels)
+        if missing <= 0:
+            return
+        connections = await gather(*(
+            self._open_connection() for _ in range(missing)
+        ), return_exceptions=True)
+        errors = []
+        for conn in connections:
+            if isinstance(conn, BaseException):
+                errors.append(conn)
+            else:
+                self._open_channels[conn] = 0
+        if errors and not self._open_channels:
+            raise errors[0]
+
+    def _connect_done(self, fut: Future):
+        self._connect_task = None
+
+    async def connect(self, count: int = 0):
+        """
+        :param count: connections wanted, at least `connection_count`
+        """
+        # all concurrent callers wait for the same connect attempt
+        if self._connect_task is None:
+            count = max(count, self._connection_count)
+            if len(self._open_channels) >= count:
+                return
+            self._connect_task = ensure_future(self._connect_missing(count))
+            self._connect_task.add_done_callback(self._connect_done)
+        await shield(self._connect_task)
+
+    def discard(self, conn: SSHClientConnection):
+        if conn in self._open_channels:
+            del self._open_channels[conn]
+            conn.close()
+            self._notify_freed()
+
+    def _notify_freed(self):
+        if self._freed is not None and not self._freed.done():
+            self._freed.set_result(None)
+
+    async def _wait_freed(self):
+        if self._freed is None or self._freed.done():
+            self._freed = get_running_loop().create_future()
+        await shield(self._freed)
+
+    async def _acquire(self) -> SSHClientConnection:
+        while True:
+            if not self._open_channels:
+                await self.connect()
+                continue
+            conn = min(self._open_channels, key=self._open_channels.__getitem__)
+            if self._open_channels[conn] < self._max_channels:
+                self._open_channels[conn] += 1
+                return conn
+            # every connection is full, open another one before waiting
+            count = len(self._open_channels)
+            if count < self._max_connections:
+                await self.connect(count + 1)
+                if len(self._open_channels) > count:
+                    continue
+            await self._wait_freed()
+
+    def _release(self, conn: SSHClientConnection):
+        if conn in self._open_channels:
+            self._open_channels[conn] -= 1
+            self._notify_freed()
+
+    @asynccontextmanager
+    async def channel(self):
+        async with self._channels:
+            conn = await self._acquire()
+            try:
+                yield conn
+            except ChannelOpenError as e:
+                if _is_connection_closed(e):
+                    self.discard(conn)
+                raise
+            finally:
+                self._release(conn)
+
+    async def _release_on_close(self, conn: SSHClientConnection, closed: Awaitable):
+        try:
+            await closed
+        finally:
+            self._release(conn)
+
+    def _hold_until_closed(self, conn: SSHClientConnection, closed: Awaitable):
+        watcher = ensure_future(self._release_on_close(conn, closed))
+        self._watchers.add(watcher)
+        watcher.add_done_callback(self._watchers.discard)
+
+    async def create_process(self, *a, **k) -> SSHClientProcess:
+        conn = await self._acquire()
+        try:
+            process = await conn.create_process(*a, **k)
+        except BaseException as e:
+            if isinstance(e, ChannelOpenError) and _is_connection_closed(e):
+                self.discard(conn)
+            self._release(conn)
+            raise
+        # process keeps its channel slot until closed
+        self._hold_until_closed(conn, process.wait_closed())
+        return process
+
+    async def open_unix_connection(self, path: str) -> Tuple[SSHReader, SSHWriter]:
+        conn = await self._acquire()
+        try:
+            reader, writer = await conn.open_unix_connection(path)
+        except BaseException as e:
+            if isinstance(e, ChannelOpenError) and _is_connection_closed(e):
+                self.discard(conn)
+            self._release(conn)
+            raise
+        self._hold_until_closed(conn, writer.channel.wait_closed())
+        return reader, writer
+
+    async def close(self):
+        connections = list(self._open_channels)
+        self._open_channels.clear()
+        for conn in connections:
+            conn.close()
+        for conn in connections:
+            await conn.wait_closed()
+
+
+class Host(ConfigObject):
+    cache_ttl: float = FloatField(default=30.)
+    cache_size: int = IntField(default=256)
+    store_dir: str = StrField(default='$HOME/.vm-store')
+    store_budget_mb: float = FloatField(default=0.)
+    store_encrypted: bool = EnField(default=False)
+    metrics_interval: float = FloatField(default=1.)
+    metrics_capacity: int = IntField(default=3600)
+    inventory_max_age: float = FloatField(default=3600.)
+    inventory_volatile_max_age: float = FloatField(default=10.)
+
+    def __init__(self, current_path: str, loader: 'ObjectLoader', data):
+        super().__init__(current_path, loader, data)
+        self._cache = ResultCache(self.cache_ttl, self.cache_size)
+        self._store: Optional[ContentStore] = None
+        self._metrics: Optional[MetricsCollector] = None
+        self._inventory: Optional[HostInventory] = None
+
+    @property
+    def store(self) -> ContentStore:
+        if self._store is None:
+            self._store = ContentStore(self, self.store_dir, self.store_budget_mb)
+        return self._store
+
+    @property
+    def metrics(self) -> MetricsCollector:
+        if self._metrics is None:
+            self._metrics = MetricsCollector(self, self.metrics_interval, self.metrics_capacity)
+        return self._metrics
+
+    @property
+    def inventory(self) -> HostInventory:
+        if self._inventory is None:
+            self._inventory = HostInventory(
+                self, self.inventory_max_age, self.inventory_volatile_max_age
+            )
+        return self._inventory
+
+    def watch_metrics(self):
+        """
+        Collect vm metrics in background task showing current rates
+        """
+        run_task(self.metrics.watch(), Task(f'{self._current_path} metrics'))
+
+    def invalidate(self, paths: Iterable[str]):
+        self._cache.invalidate(paths)
+
+    def get_special_path(self, special_name) -> Optional[str]:
+        if special_name == 'host':
+            return '.'
+
+    async def create_process(self, cmd: str, input: Optional[AnyStr] = None, env=()):
+        raise NotImplementedError(f'create_process unimplemented for {self.__class__.__name__}')
+
+    async def open_unix_connection(self, path: str):
+        """
+        Stream reader and writer connected to unix socket on host
+        """
+        raise NotImplementedError(f'open_unix_connection unimplemented for {self.__class__.__name__}')
+
+    async def _exec(
+            self, cmd: str, input: Optional[bytes] = None,
+            timeout: Optional[float] = None, envs: Iterable[Tuple[str, str]] = (),
+            retry_count: int = 3
+    ) -> CommandResult:
+        raise NotImplementedError(f'_exec unimplemented for {self.__class__.__name__}')
+
+    async def run_command(
+            self, cmd: str, input: Optional[AnyStr] = None,
+            timeout: Optional[float] = None, envs: Iterable[Tuple[str, str]] = (),
+            retry_count: int = 3, idempotent: bool = False, invalidates: Iterable[str] = (),
+            quiet: bool = False
+    ) -> str:
+        """
+        :param idempotent: result may be served from cache until ttl or invalidation
+        :param invalidates: paths changed by the command, cached results mentioning them are dropped
+        :param quiet: do not print the command, for periodic ones
+        """
+        envs = tuple(envs)
+        key = (cmd, envs, 'command') if idempotent and input is None else None
+        if key is not None:
+            res = self._cache.get(key)
+            if res is not None:
+                return res.check()
+
+        if not quiet:
+            print(f'{cmd} input={input}')
+        if isinstance(input, str):
+            input = input.encode('utf-8')
+        self._cache.invalidate(invalidates)
+        res = await self._exec(
+            cmd, input=input, timeout=timeout, envs=envs, retry_count=retry_count
+        )
+        self._cache.invalidate(invalidates)
+        if key is not None and res.exit_code == 0:
+            self._cache.put(key, res)
+        return res.check()
+
+    async def run_batch(
+            self, cmds: Iterable[str], timeout: Optional[float] = None,
+            envs: Iterable[Tuple[str, str]] = (), retry_count: int = 3,
+            idempotent: bool = False, invalidates: Iterable[str] = ()
+    ) -> List[CommandResult]:
+        cmds = list(cmds)
+        envs = tuple(envs)
+        key = ('\n'.join(cmds), envs, 'batch') if idempotent else None
+        if key is not None:
+            results = self._cache.get(key)
+            if results is not None:
+                return results
+
+        print(f'batch {cmds}')
+        script, markers = frame_batch(cmds)
+        self._cache.invalidate(invalidates)
+        res = await self._exec(
+            script, timeout=timeout, envs=envs, retry_count=retry_count
+        )
+        self._cache.invalidate(invalidates)
+        results = split_batch(cmds, markers, res.stdout, res.stderr)
+        if key is not None and all(r.exit_code == 0 for r in results):
+            self._cache.put(key, results)
+        return results
+
+    async def stream_command(
+            self, cmd: str, input: Optional[AnyStr] = None,
+            envs: Iterable[Tuple[str, str]] = (), chunk_size: int = int(2 ** 16),
+            lines: bool = False, idempotent: bool = False
+    ) -> AsyncIterator[bytes]:
+        """
+        Yield stdout chunks (or lines) as they arrive, raise `CommandError` at the end on failure.
+        Output is not read ahead of the consumer, so a slow consumer throttles the command.
+        """
+        envs = tuple(envs)
+        key = (cmd, (envs, lines), 'stream') if idempotent and input is None else None
+        if key is not None:
+            cached = self._cache.get(key)
+            if cached is not None:
+                for data in cached:
+                    yield data
+                return
+        collected = []
+
+        print(f'{cmd} input={input} (stream)')
+        process = await self.create_process(cmd, input=input, env=envs)
+        # stderr is drained in background so the command never blocks on it
+        stderr_task = create_task(process.stderr.read())
+        finished = False
+        try:
+            while True:
+                if lines:
+                    data = await process.stdout.readline()
+                else:
+                    data = await process.stdout.read(chunk_size)
+                if not data:
+                    break
+                if key is not None:
+                    collected.append(data)
+                yield data
+            exit_code = (await process.wait()).returncode
+            stderr = await stderr_task
+            finished = True
+        finally:
+            if not finished:
+                stderr_task.cancel()
+                process.close()
+
+        CommandResult(cmd, exit_code, b'', stderr).check()
+        if key is not None:
+            self._cache.put(key, collected)
+
+
+class SSHHost(Host):
     host: str = StrField()
     port: int = IntField(default=22)
     username: str = StrField(default=getlogin())
     password: str = StrField(default='')
     compression: bool = EnField(default=False)
+    connections: int = IntField(default=1)
+    max_channels: int = IntField(default=10)
+    max_connections: int = IntField(default=8)
+    persistent_shell: bool = EnField(default=False)
+    accept_new_host_keys: bool = EnField(default=False)
 
-    session: Optional[SSHClientConnection] = None
+    pool: Optional[SSHConnectionPool] = None
 
     _last_port = 33354
 
+    def __init__(self, current_path: str, loader: 'ObjectLoader', data):
+        super().__init__(current_path, loader, data)
+        self._shells: List[RemoteShell] = []
+        self._shells_lock = Lock()
+
     @property
     def next_free_port(self):
         # TODO: check used
@@ -111,14 +461,9 @@ class SSHHost(ConfigObject):
     #         # 'compression': False,
     #     }))
 
-    def get_special_path(self, special_name) -> Optional[str]:
-        if special_name == 'host':
-            return '.'
-
-    @StateChange('loaded', 'connected')
-    async def connect(self):
+    async def _open_connection(self) -> SSHClientConnection:
         print('connecting...')
-        self.session = await connect(
+        conn = await connect(
             host=self.host,
             port=self.port,
             username=self.username or None,
@@ -129,43 +474,187 @@ class SSHHost(ConfigObject):
             ),
         )
         print('connected')
+        return conn
+
+    def ssh_command(self, cmd: str) -> str:
+        """
+        Command running `cmd` on this host from another host, needs key auth between them
+        and this host in known hosts there, unless `accept_new_host_keys` trusts it on first use
+        """
+        target = f'{self.username}@{self.host}' if self.username else self.host
+        options = '-o BatchMode=yes '
+        if self.accept_new_host_keys:
+            options += '-o StrictHostKeyChecking=accept-new '
+        return f'ssh {options}-p {self.port} {target} {quote(cmd)}'
+
+    @StateChange('loaded', 'connected')
+    async def connect(self):
+        if self.pool is None:
+            self.pool = SSHConnectionPool(
+                self._open_connection, self.connections, self.max_channels, self.max_connections
+            )
+        await self.pool.connect()
 
     @StateChange('connected', 'loaded')
     async def disconnect(self):
-        session = self.session
-        self.session = None
-        session.close()
-        await session.wait_closed()
+        for shell in self._shells:
+            shell.close()
+        self._shells = []
+        pool = self.pool
+        self.pool = None
+        await pool.close()
 
-    async def run_command(
-            self, cmd: str, input: Optional[AnyStr] = None,
+    async def create_process(self, *a, **k) -> SSHClientProcess:
+        return await (await self.withstate('connected')).pool.create_process(*a, **k)
+
+    async def open_unix_connection(self, path: str) -> Tuple[SSHReader, SSHWriter]:
+        return await (await self.withstate('connected')).pool.open_unix_connection(path)
+
+    async def _get_shell(self) -> RemoteShell:
+        # shell count is checked and raised by one caller at a time
+        async with self._shells_lock:
+            self._shells = [shell for shell in self._shells if not shell.closed]
+            for shell in self._shells:
+                if not shell.busy:
+                    return shell
+            # one shell per pooled connection
+            if len(self._shells) < self.connections:
+                shell = RemoteShell(await self.create_process('sh'))
+                self._shells.append(shell)
+                return shell
+            return min(self._shells, key=lambda shell: shell.waiting)
+
+    async def _run_in_shell(
+            self, cmd: str, input: Optional[bytes], timeout: Optional[float],
+            envs: Iterable[Tuple[str, str]]
+    ) -> CommandResult:
+        shell = await self._get_shell()
+        return await wait_for(shell.run(cmd, input=input, envs=envs), timeout)
+
+    async def _run_in_channel(
+            self, cmd: str, input: Optional[bytes], timeout: Optional[float],
+            envs: Iterable[Tuple[str, str]]
+    ) -> CommandResult:
+        host = await self.withstate('connected')
+        async with host.pool.channel() as conn:
+            res = await conn.run(
+                cmd, input=input, timeout=timeout, env=envs
+            )
+        return CommandResult(cmd, res.returncode, res.stdout, res.stderr)
+
+    async def _exec(
+            self, cmd: str, input: Optional[bytes] = None,
             timeout: Optional[float] = None, envs: Iterable[Tuple[str, str]] = (),
             retry_count: int = 3
-    ) -> str:
-        print(f'{cmd} input={input}')
-        if isinstance(input, str):
-            input = input.encode('utf-8')
+    ) -> CommandResult:
         try:
-            res = await (await self.withstate('connected')).session.run(
-                cmd, input=input, timeout=timeout, env=envs
-            )
-        except ChannelOpenError as e:
-            if 'SSH connection closed' in str(e) and retry_count > 0:
+            if self.persistent_shell:
+                return await self._run_in_shell(cmd, input, timeout, envs)
+            else:
+                return await self._run_in_channel(cmd, input, timeout, envs)
+        except (ChannelOpenError, ShellClosedError) as e:
+            # only commands that were never sent are retried, others may have run already
+            if isinstance(e, ChannelOpenError) and not _is_connection_closed(e):
+                raise
+            if retry_count > 0:
                 print('try reconnecting')
-                await self.connect.func(self)
-                return await self.run_command(
-                    cmd=cmd, timeout=timeout,
+                return await self._exec(
+                    cmd=cmd, input=input, timeout=timeout,
                     envs=envs, retry_count=retry_count - 1
                 )
             raise
 
-        exit_code = res.returncode
-        if exit_code is None:
-            raise RuntimeError('Unknown error')
-        if exit_code:
-            raise CommandError(
-                f'Command `{cmd}` failed with code {exit_code}; '
-                f'stderr: {decode_data(res.stderr)}'
-            )
 
-        return decode_data(res.stdout)
+class LocalProcess:
+    """
+    asyncio subprocess with the part of `SSHClientProcess` interface used by envs
+    """
+
+    def __init__(self, process: Process):
+        self._process = process
+        self.stdin = process.stdin
+        self.stdout = process.stdout
+        self.stderr = process.stderr
+        # stands for ssh channel in write buffer queries
+        self.channel = process.stdin.transport
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self._process.returncode
+
+    @property
+    def pid(self) -> int:
+        return self._process.pid
+
+    async def wait(self, timeout: Optional[float] = None) -> 'LocalProcess':
+        await wait_for(self._process.wait(), timeout)
+        return self
+
+    async def wait_closed(self):
+        await self._process.wait()
+
+    def terminate(self):
+        try:
+            self._process.terminate()
+        except ProcessLookupError:
+            pass
+
+    def kill(self):
+        try:
+            self._process.kill()
+        except ProcessLookupError:
+            pass
+
+    def close(self):
+        # shell wrapper may not pass signal to its child, closed stdin ends it like closed channel
+        self.stdin.close()
+        self.terminate()
+
+
+class LocalHost(Host):
+    @StateChange('loaded', 'connected')
+    async def connect(self):
+        pass
+
+    @StateChange('connected', 'loaded')
+    async def disconnect(self):
+        pass
+
+    async def _spawn(self, cmd: str, envs: Iterable[Tuple[str, str]] = ()) -> Process:
+        envs = dict(envs)
+        # same working directory as a fresh ssh session
+        return await create_subprocess_shell(
+            cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+            env={**environ, **envs} if envs else None,
+            cwd=expanduser('~'), limit=int(2 ** 20),
+        )
+
+    async def create_process(
+            self, cmd: str, input: Optional[AnyStr] = None, env: Iterable[Tuple[str, str]] = ()
+    ) -> LocalProcess:
+        process = await self._spawn(cmd, env)
+        if input is not None:
+            if isinstance(input, str):
+                input = input.encode('utf-8')
+            process.stdin.write(input)
+            process.stdin.write_eof()
+        return LocalProcess(process)
+
+    async def open_unix_connection(self, path: str) -> Tuple[StreamReader, StreamWriter]:
+        return await asyncio_open_unix_connection(path)
+
+    async def _exec(
+            self, cmd: str, input: Optional[bytes] = None,
+            timeout: Optional[float] = None, envs: Iterable[Tuple[str, str]] = (),
+            retry_count: int = 3
+    ) -> CommandResult:
+        process = await self._spawn(cmd, envs)
+        try:
+            stdout, stderr = await wait_for(process.communicate(input), timeout)
+        except BaseException:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            raise
+        return CommandResult(cmd, process.returncode, stdout, stderr)
@@ -0,0 +1,213 @@
+from time import monotonic
+from typing import NamedTuple, Tuple, Dict, Iterable, List, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from host import Host
+
+
+class NumaNode(NamedTuple):
+    node: int
+    cpus: Tuple[int, ...]
+    mem_total_mb: float
+    mem_free_mb: float
+
+
+class HugepagePool(NamedTuple):
+    page_kb: int
+    total: int
+    free: int
+
+
+class DiskUsage(NamedTuple):
+    path: str
+    total_mb: float
+    free_mb: float
+
+
+class HostProfile(NamedTuple):
+    cpu_model: str
+    cpus: int
+    sockets: int
+    cores: int
+    numa_nodes: Tuple[NumaNode, ...]
+    mem_total_mb: float
+    mem_available_mb: float
+    hugepages: Tuple[HugepagePool, ...]
+    iommu_groups: Dict[int, Tuple[str, ...]]
+    kvm: str  # rw, ro or missing
+    disks: Dict[str, DiskUsage]
+    probed_at: float
+    refreshed_at: float
+
+    @property
+    def free_hugepages_mb(self) -> float:
+        return sum(pool.free * pool.page_kb for pool in self.hugepages) / 1024.
+
+
+_SECTIONS = {
+    'model': "sed -n 's/^model name[[:space:]]*: //p' /proc/cpuinfo | head -n 1",
+    'cpu': "lscpu -p=CPU,CORE,SOCKET,NODE | grep -v '^#'",
+    'numa': (
+        'for n in /sys/devices/system/node/node[0-9]*; do '
+        '[ -d "$n" ] && echo "${n##*node} $(cat $n/cpulist)'
+        " $(sed -n 's/.*MemTotal: *\\([0-9]*\\).*/\\1/p' $n/meminfo)"
+        " $(sed -n 's/.*MemFree: *\\([0-9]*\\).*/\\1/p' $n/meminfo)\"; done"
+    ),
+    'meminfo': "grep -E '^(MemTotal|MemAvailable):' /proc/meminfo",
+    'hugepages': (
+        'for h in /sys/kernel/mm/hugepages/hugepages-*; do '
+        '[ -d "$h" ] && echo "${h##*-} $(cat $h/nr_hugepages) $(cat $h/free_hugepages)"; done'
+    ),
+    'iommu': 'for d in /sys/kernel/iommu_groups/*/devices/*; do [ -e "$d" ] && echo "$d"; done',
+    'kvm': '( [ -w /dev/kvm ] && echo rw ) || ( [ -e /dev/kvm ] && echo ro ) || echo missing',
+}
+
+VOLATILE_SECTIONS = ('numa', 'meminfo', 'hugepages', 'df')
+
+
+def _df_cmd(paths: Iterable[str]) -> str:
+    cmds = []
+    for path in paths:
+        # home relative like ssh session, ~ is not expanded in quotes
+        quoted = f'"$HOME{path[1:]}"' if path.startswith('~') else f'"{path}"'
+        # env dirs are created lazily, free space of nearest existing parent is used,
+        # -1 -1 marks failed df
+        cmds.append(
+            f'p={quoted}; while [ ! -e "$p" ] && [ "$p" != / ]; do p=$(dirname "$p"); done; '
+            f'echo "$( ( df -Pk "$p" || echo - -1 - -1 ) | tail -n 1 | awk \'{{print $2, $4}}\') {path}"'
+        )
+    return '; '.join(cmds)
+
+
+def probe_script(sections: Iterable[str], paths: Iterable[str] = ()) -> str:
+    """
+    One script printing `@@ <section>` before output of every section
+    """
+    parts = []
+    for section in sections:
+        cmd = _df_cmd(paths) if section == 'df' else _SECTIONS[section]
+        parts.append(f"echo '@@ {section}'; {{ {cmd or ':'}; }} 2> /dev/null")
+    return '\n'.join(parts)
+
+
+def split_sections(output: str) -> Dict[str, List[str]]:
+    sections = {}
+    current = None
+    for line in output.splitlines():
+        if line.startswith('@@ '):
+            current = sections[line[3:].strip()] = []
+        elif current is not None and line.strip():
+            current.append(line.strip())
+    return sections
+
+
+def _parse_cpu_list(cpus: str) -> Tuple[int, ...]:
+    result = []
+    for part in cpus.split(','):
+        if part:
+            first, _, last = part.partition('-')
+            result.extend(range(int(first), int(last or first) + 1))
+    return tuple(result)
+
+
+def parse_volatile(sections: Dict[str, List[str]]) -> Dict[str, object]:
+    values = {}
+    if 'numa' in sections:
+        nodes = []
+        for line in sections['numa']:
+            node, cpus, total, free = (line.split() + ['0', '0'])[:4]
+            nodes.append(NumaNode(int(node), _parse_cpu_list(cpus), int(total) / 1024., int(free) / 1024.))
+        values['numa_nodes'] = tuple(nodes)
+    if 'meminfo' in sections:
+        meminfo = {}
+        for line in sections['meminfo']:
+            name, amount = line.split(':', 1)
+            meminfo[name] = int(amount.split()[0]) / 1024.
+        values['mem_total_mb'] = meminfo.get('MemTotal', 0.)
+        values['mem_available_mb'] = meminfo.get('MemAvailable', 0.)
+    if 'hugepages' in sections:
+        values['hugepages'] = tuple(
+            HugepagePool(int(size.rstrip('kB')), int(total), int(free))
+            for size, total, free in (line.split() for line in sections['hugepages'])
+        )
+    if 'df' in sections:
+        disks = {}
+        for line in sections['df']:
+            parts = line.split(' ', 2)
+            if len(parts) != 3 or not parts[0].isdigit() or not parts[1].isdigit():
+                print(f'Bad df line `{line}`')
+                continue
+            total, free, path = parts
+            disks[path] = DiskUsage(path, int(total) / 1024., int(free) / 1024.)
+        values['disks'] = disks
+    return values
+
+
+def parse_profile(sections: Dict[str, List[str]], t: float) -> HostProfile:
+    cpu_rows = [line.split(',') for line in sections.get('cpu', ())]
+    iommu_groups: Dict[int, List[str]] = {}
+    for line in sections.get('iommu', ()):
+        # /sys/kernel/iommu_groups/<group>/devices/<pci id>
+        parts = line.split('/')
+        iommu_groups.setdefault(int(parts[4]), []).append(parts[6])
+    values = dict(
+        cpu_model=(sections.get('model') or [''])[0],
+        cpus=len(cpu_rows),
+        sockets=len({row[2] for row in cpu_rows}),
+        cores=len({(row[2], row[1]) for row in cpu_rows}),
+        numa_nodes=(),
+        mem_total_mb=0.,
+        mem_available_mb=0.,
+        hugepages=(),
+        iommu_groups={group: tuple(devices) for group, devices in iommu_groups.items()},
+        kvm=(sections.get('kvm') or ['missing'])[0],
+        disks={},
+        probed_at=t,
+        refreshed_at=t,
+    )
+    values.update(parse_volatile(sections))
+    return HostProfile(**values)
+
+
+class HostInventory:
+    """
+    Cached host profile, volatile fields (memory, hugepages, disk) are refreshed separately
+    """
+
+    def __init__(self, host: 'Host', max_age: float = 3600., volatile_max_age: float = 10.):
+        self._host = host
+        self.max_age = max_age
+        self.volatile_max_age = volatile_max_age
+        self.paths: Tuple[str, ...] = ()
+        self._profile: Optional[HostProfile] = None
+
+    async def probe(self, paths: Iterable[str] = ()) -> HostProfile:
+        self.paths = tuple(sorted(set(self.paths) | set(paths)))
+        output = await self._host.run_command(probe_script(list(_SECTIONS) + ['df'], self.paths))
+        self._profile = parse_profile(split_sections(output), monotonic())
+        return self._profile
+
+    async def refresh_volatile(self) -> HostProfile:
+        if self._profile is None:
+            return await self.probe()
+        output = await self._host.run_command(probe_script(VOLATILE_SECTIONS, self.paths))
+        self._profile = self._profile._replace(
+            refreshed_at=monotonic(), **parse_volatile(split_sections(output))
+        )
+        return self._profile
+
+    async def profile(self, paths: Iterable[str] = (), max_age: Optional[float] = None) -> HostProfile:
+        """
+        :param paths: directories whose free space is needed, remembered for later refreshes
+        :param max_age: seconds after which volatile fields are refreshed, `volatile_max_age` by default
+        """
+        paths = set(paths)
+        now = monotonic()
+        profile = self._profile
+        if profile is None or now - profile.probed_at > self.max_age or not paths <= set(self.paths):
+            return await self.probe(paths)
+        if max_age is None:
+            max_age = self.volatile_max_age
+        if now - profile.refreshed_at > max_age:
+            return await self.refresh_volatile()
+        return profile
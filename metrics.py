@@ -0,0 +1,217 @@
+from array import array
+from asyncio import sleep
+from math import nan
+from typing import Dict, List, Optional, Sequence, TYPE_CHECKING, Tuple, AsyncIterator
+
+if TYPE_CHECKING:
+    from host import Host
+
+
+class TimeSeries:
+    """
+    Last `capacity` samples of numeric fields in preallocated arrays
+    """
+
+    def __init__(self, fields: Sequence[str], capacity: int = 3600):
+        self.fields = tuple(fields)
+        self.capacity = max(capacity, 1)
+        self._times = array('d', [0.]) * self.capacity
+        self._values = {field: array('d', [0.]) * self.capacity for field in self.fields}
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, t: float, values: Dict[str, float]):
+        i = self._next
+        self._times[i] = t
+        for field in self.fields:
+            self._values[field][i] = values.get(field, nan)
+        self._next = (i + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def _ordered(self, data: array) -> array:
+        start = (self._next - self._count) % self.capacity
+        end = start + self._count
+        if end <= self.capacity:
+            return data[start:end]
+        return data[start:] + data[:end - self.capacity]
+
+    def times(self) -> array:
+        return self._ordered(self._times)
+
+    def values(self, field: str) -> array:
+        return self._ordered(self._values[field])
+
+    def last(self) -> Optional[Dict[str, float]]:
+        if not self._count:
+            return None
+        i = (self._next - 1) % self.capacity
+        last = {field: values[i] for field, values in self._values.items()}
+        last['time'] = self._times[i]
+        return last
+
+
+VM_FIELDS = ('cpu', 'rss', 'disk_read', 'disk_write', 'net_rx', 'net_tx', 'cgroup_mem')
+
+# one round trip samples all qemu processes, every line is prefixed by its source
+_SAMPLE_SCRIPT = r'''
+echo "time $(date +%s.%N)"
+echo "hz $(getconf CLK_TCK)"
+for p in $(pgrep -f '^qemu-system-'); do
+  [ -r /proc/$p/stat ] || continue
+  echo "pid $p"
+  printf 'cmd '; tr '\0\n' '\t ' < /proc/$p/cmdline; echo
+  printf 'stat '; cat /proc/$p/stat
+  grep -E '^(VmRSS|Threads):' /proc/$p/status | sed 's/^/status /'
+  sed 's/^/io /' /proc/$p/io 2> /dev/null
+  cg=/sys/fs/cgroup$(sed -n 's/^0:://p' /proc/$p/cgroup)
+  [ -r "$cg/memory.current" ] && echo "cgmem $(cat "$cg/memory.current")"
+  for i in $(tr '\0' '\n' < /proc/$p/cmdline | sed -n 's/.*ifname=\([^,]*\).*/\1/p'); do
+    echo "net $i $(cat /sys/class/net/$i/statistics/rx_bytes) $(cat /sys/class/net/$i/statistics/tx_bytes)"
+  done
+done
+'''
+
+
+class ProcessSample:
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.name = str(pid)
+        # monitor socket path is unique per vm on host, names are not
+        self.key = self.name
+        self.cpu_ticks = 0
+        self.rss = 0.
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.net_rx = 0
+        self.net_tx = 0
+        self.cgroup_mem = nan
+
+    def parse_cmd(self, args: List[str]):
+        for arg, value in zip(args, args[1:]):
+            if arg == '-name':
+                self.name = value.split(',')[0]
+            elif arg == '-qmp' and value.startswith('unix:'):
+                self.key = value[len('unix:'):].split(',')[0]
+
+    def parse(self, key: str, value: str):
+        if key == 'cmd':
+            self.parse_cmd(value.split('\t'))
+        elif key == 'stat':
+            # command name in parentheses may contain spaces
+            stat = value[value.rindex(')') + 2:].split()
+            self.cpu_ticks = int(stat[11]) + int(stat[12])
+        elif key == 'status':
+            name, amount = value.split(':', 1)
+            if name == 'VmRSS':
+                self.rss = float(amount.split()[0]) * 1024
+        elif key == 'io':
+            name, amount = value.split(':', 1)
+            if name == 'read_bytes':
+                self.read_bytes = int(amount)
+            elif name == 'write_bytes':
+                self.write_bytes = int(amount)
+        elif key == 'cgmem':
+            self.cgroup_mem = float(value)
+        elif key == 'net':
+            _, rx, tx = value.split()
+            self.net_rx += int(rx)
+            self.net_tx += int(tx)
+
+
+def parse_sample(output: str) -> Tuple[float, int, List[ProcessSample]]:
+    t = 0.
+    hz = 100
+    processes = []
+    current = None
+    for line in output.splitlines():
+        key, _, value = line.partition(' ')
+        if key == 'time':
+            t = float(value)
+        elif key == 'hz':
+            hz = int(value)
+        elif key == 'pid':
+            current = ProcessSample(int(value))
+            processes.append(current)
+        elif current is not None:
+            try:
+                current.parse(key, value)
+            except (ValueError, IndexError) as e:
+                print(f'Bad {key} metrics line of {current.pid}', e)
+    return t, hz, processes
+
+
+class MetricsCollector:
+    """
+    Samples all qemu processes of host with one command per interval,
+    rates are kept in time series by monitor socket path of vm
+    """
+
+    def __init__(self, host: 'Host', interval: float = 1., capacity: int = 3600):
+        self._host = host
+        self.interval = interval
+        self.capacity = capacity
+        self.series: Dict[str, TimeSeries] = {}
+        self._previous: Dict[str, Tuple[float, ProcessSample]] = {}
+        self.names: Dict[str, str] = {}
+
+    def _rates(self, t: float, hz: int, sample: ProcessSample) -> Optional[Dict[str, float]]:
+        previous = self._previous.get(sample.key)
+        self._previous[sample.key] = (t, sample)
+        if previous is None or previous[1].pid != sample.pid or t <= previous[0]:
+            return None
+        prev_t, prev = previous
+        dt = t - prev_t
+        return dict(
+            cpu=(sample.cpu_ticks - prev.cpu_ticks) / hz / dt * 100.,
+            rss=sample.rss,
+            disk_read=(sample.read_bytes - prev.read_bytes) / dt,
+            disk_write=(sample.write_bytes - prev.write_bytes) / dt,
+            net_rx=(sample.net_rx - prev.net_rx) / dt,
+            net_tx=(sample.net_tx - prev.net_tx) / dt,
+            cgroup_mem=sample.cgroup_mem,
+        )
+
+    async def sample(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: rates of vms sampled before by their key
+        """
+        t, hz, processes = parse_sample(await self._host.run_command(_SAMPLE_SCRIPT, quiet=True))
+        running = set()
+        rates = {}
+        for sample in processes:
+            running.add(sample.key)
+            self.names[sample.key] = sample.name
+            values = self._rates(t, hz, sample)
+            if values is None:
+                continue
+            series = self.series.get(sample.key)
+            if series is None:
+                series = self.series[sample.key] = TimeSeries(VM_FIELDS, self.capacity)
+            series.append(t, values)
+            rates[sample.key] = values
+        for key in set(self._previous) - running:
+            del self._previous[key]
+            del self.names[key]
+        return rates
+
+    async def run(self):
+        while True:
+            await self.sample()
+            await sleep(self.interval)
+
+    async def watch(self) -> AsyncIterator[str]:
+        """
+        Sample forever, yields summary line for task message
+        """
+        while True:
+            rates = await self.sample()
+            yield ' | '.join(
+                f'{self.names[key]}: cpu {values["cpu"]:.0f}% rss {values["rss"] / 2 ** 20:.0f}M '
+                f'disk {values["disk_read"] / 2 ** 20:.1f}/{values["disk_write"] / 2 ** 20:.1f}M/s '
+                f'net {values["net_rx"] / 2 ** 20:.1f}/{values["net_tx"] / 2 ** 20:.1f}M/s'
+                for key, values in sorted(rates.items())
+            ) or 'no running vms'
+            await sleep(self.interval)
@@ -0,0 +1,229 @@
+import gzip
+import re
+from asyncio import gather
+from bisect import bisect_right
+from collections import deque
+from tempfile import TemporaryFile
+from typing import NamedTuple, List, Deque, Tuple, Optional, Dict, Iterator, Callable, AnyStr, Union
+
+from gui import decode_data
+
+
+class OutputLine(NamedTuple):
+    number: int
+    stream: str
+    text: str
+
+
+class OutputBuffer:
+    """
+    Line-indexed output of one process, last lines are kept in memory
+    and older ones spooled to temporary file in gzip members of `segment_lines` lines
+    """
+
+    def __init__(
+            self, max_lines: int = 10000, max_bytes: int = int(2 ** 22),
+            max_line_bytes: int = int(2 ** 16), segment_lines: int = 1000,
+            spool: bool = True
+    ):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.max_line_bytes = max_line_bytes
+        self.segment_lines = segment_lines
+        self._lines: Deque[Tuple[str, bytes]] = deque()
+        self._bytes = 0
+        # number of the first line in `_lines`
+        self._first = 0
+        self._partial: Dict[str, bytes] = {}
+
+        self._spool = TemporaryFile('w+b') if spool else None
+        self._segments: List[Tuple[int, int]] = []  # (first line number, file offset)
+        self._spool_end = 0
+        self._pending: List[Tuple[str, bytes]] = []
+        self._pending_first = 0
+        # lines before that number are lost when spooling is off
+        self.dropped = 0
+
+    @property
+    def line_count(self) -> int:
+        return self._first + len(self._lines)
+
+    def feed(self, stream: str, data: bytes):
+        data = self._partial.pop(stream, b'') + data
+        start = 0
+        while True:
+            end = data.find(b'\n', start)
+            if end < 0:
+                break
+            self._push(stream, data[start:end])
+            start = end + 1
+        rest = data[start:]
+        while len(rest) > self.max_line_bytes:
+            self._push(stream, rest[:self.max_line_bytes])
+            rest = rest[self.max_line_bytes:]
+        if rest:
+            self._partial[stream] = rest
+
+    def flush(self):
+        """
+        Add unterminated lines, called when streams ended
+        """
+        partial = self._partial
+        self._partial = {}
+        for stream, data in partial.items():
+            self._push(stream, data)
+
+    def _push(self, stream: str, line: bytes):
+        self._lines.append((stream, line))
+        self._bytes += len(line)
+        while len(self._lines) > self.max_lines or self._bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        stream, line = self._lines.popleft()
+        self._bytes -= len(line)
+        self._first += 1
+        if self._spool is None:
+            self.dropped = self._first
+            return
+        if not self._pending:
+            self._pending_first = self._first - 1
+        self._pending.append((stream, line))
+        if len(self._pending) >= self.segment_lines:
+            self._write_segment()
+
+    def _write_segment(self):
+        member = gzip.compress(b''.join(
+            stream.encode('ascii') + b' ' + line + b'\n' for stream, line in self._pending
+        ))
+        self._spool.seek(self._spool_end)
+        self._spool.write(member)
+        self._segments.append((self._pending_first, self._spool_end))
+        self._spool_end += len(member)
+        self._pending = []
+
+    def _read_segment(self, i: int) -> List[Tuple[str, bytes]]:
+        _, offset = self._segments[i]
+        end = self._segments[i + 1][1] if i + 1 < len(self._segments) else self._spool_end
+        self._spool.seek(offset)
+        data = gzip.decompress(self._spool.read(end - offset))
+        lines = []
+        for record in data.split(b'\n')[:-1]:
+            stream, _, line = record.partition(b' ')
+            lines.append((stream.decode('ascii'), line))
+        return lines
+
+    def _iter_from(self, start: int) -> Iterator[OutputLine]:
+        start = max(start, self.dropped)
+        segments_end = self._pending_first if self._pending else self._first
+        if self._segments and start < segments_end:
+            i = max(bisect_right(self._segments, (start, float('inf'))) - 1, 0)
+            for i in range(i, len(self._segments)):
+                number = self._segments[i][0]
+                for stream, line in self._read_segment(i):
+                    if number >= start:
+                        yield OutputLine(number, stream, decode_data(line))
+                    number += 1
+        for number in range(max(start, self._pending_first), self._pending_first + len(self._pending)):
+            stream, line = self._pending[number - self._pending_first]
+            yield OutputLine(number, stream, decode_data(line))
+        # deque is indexed from its nearer end, tail does not walk older lines
+        for number in range(max(start, self._first), self.line_count):
+            stream, line = self._lines[number - self._first]
+            yield OutputLine(number, stream, decode_data(line))
+
+    def range(self, start: int, stop: Optional[int] = None) -> List[OutputLine]:
+        stop = self.line_count if stop is None else min(stop, self.line_count)
+        lines = []
+        if start >= stop:
+            return lines
+        for line in self._iter_from(start):
+            if line.number >= stop:
+                break
+            lines.append(line)
+        return lines
+
+    @property
+    def last_line(self) -> str:
+        if self._lines:
+            return decode_data(self._lines[-1][1])
+        tail = self.tail(1)
+        return tail[0].text if tail else ''
+
+    def tail(self, count: int = 100) -> List[OutputLine]:
+        return self.range(max(self.line_count - count, 0))
+
+    def search(
+            self, pattern: Union[str, 're.Pattern'], limit: int = 100,
+            stream: Optional[str] = None
+    ) -> List[OutputLine]:
+        """
+        Oldest `limit` lines matching regex, spooled lines included
+        """
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern)
+        found = []
+        for line in self._iter_from(0):
+            if stream is not None and line.stream != stream:
+                continue
+            if pattern.search(line.text):
+                found.append(line)
+                if len(found) >= limit:
+                    break
+        return found
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+            self._segments = []
+            self._pending = []
+            self.dropped = self._first
+
+
+class ProcessOutput:
+    """
+    Reads stdout and stderr of a process until both are closed,
+    spool of the buffer is closed when process ends, its last lines stay in memory
+    """
+
+    def __init__(
+            self, process, buffer: Optional[OutputBuffer] = None,
+            on_data: Optional[Callable[['ProcessOutput'], None]] = None,
+            chunk_size: int = int(2 ** 16)
+    ):
+        self.process = process
+        self.buffer = buffer or OutputBuffer()
+        self.on_data = on_data
+        self.chunk_size = chunk_size
+        self.exit_code: Optional[int] = None
+
+    @property
+    def last_line(self) -> str:
+        return self.buffer.last_line
+
+    async def _read(self, stream: str, reader):
+        while True:
+            data: AnyStr = await reader.read(self.chunk_size)
+            if not data:
+                break
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            self.buffer.feed(stream, data)
+            if self.on_data is not None:
+                self.on_data(self)
+
+    async def run(self) -> Optional[int]:
+        try:
+            await gather(
+                self._read('out', self.process.stdout),
+                self._read('err', self.process.stderr),
+            )
+            self.buffer.flush()
+            completed = await self.process.wait()
+            self.exit_code = completed.returncode
+        finally:
+            if self.exit_code is None:
+                self.process.terminate()
+            self.buffer.close()
+        return self.exit_code
@@ -0,0 +1,277 @@
+from asyncio import gather
+from bisect import bisect_left, insort
+from os.path import isdir, exists
+from typing import NamedTuple, Dict, List, Tuple, Optional, Iterable, Iterator, Callable
+
+from env import Env
+from gpu import GPUS
+from host import Host
+from loader import ObjectLoader
+from vm import QemuVM, DriveImage
+
+
+class VMRequirements(NamedTuple):
+    smp: int
+    ram_mb: float
+    disk_mb: float = 0.
+    gpu_count: int = 0
+    gpu_min_ram_mb: float = 0.
+
+    @classmethod
+    def of_vm(cls, vm: QemuVM) -> 'VMRequirements':
+        drives = [vm.o(d.strip()) for d in vm.drives.split(',') if d.strip()]
+        return cls(
+            smp=vm.smp,
+            ram_mb=vm.ram_mb,
+            # isos and overlays of backing files do not take their size_mb
+            disk_mb=sum(
+                drive.size_mb for drive in drives
+                if isinstance(drive, DriveImage) and drive.format == 'qcow2' and not drive.base_img_path
+            ),
+            gpu_count=vm.gpu_count,
+            gpu_min_ram_mb=vm.gpu_min_ram_mb,
+        )
+
+
+class Placement(NamedTuple):
+    vm_path: str
+    host_path: str
+    env_path: str
+    requirements: VMRequirements
+    gpus: Tuple[float, ...] = ()
+
+
+class HostCapacity:
+    """
+    Free resources of host as seen by scheduler
+    """
+
+    def __init__(
+            self, path: str, vcpus: float, free_ram_mb: float,
+            gpus: Iterable[float], env_free_mb: Dict[str, float]
+    ):
+        self.path = path
+        self.free_vcpus = vcpus
+        self.free_ram_mb = free_ram_mb
+        # ram of free gpus, ascending
+        self.gpus: List[float] = sorted(gpus)
+        self.env_free_mb = env_free_mb
+
+    def free_gpus(self, min_ram_mb: float = 0.) -> int:
+        return len(self.gpus) - bisect_left(self.gpus, min_ram_mb)
+
+    def pick_env(self, req: VMRequirements) -> Optional[str]:
+        """
+        Env with most free disk
+        """
+        if not self.env_free_mb:
+            return None
+        env_path, free_mb = max(self.env_free_mb.items(), key=lambda item: item[1])
+        return env_path if free_mb >= req.disk_mb else None
+
+    def fits(self, req: VMRequirements) -> bool:
+        return (
+                self.free_vcpus >= req.smp
+                and self.free_ram_mb >= req.ram_mb
+                and self.free_gpus(req.gpu_min_ram_mb) >= req.gpu_count
+                and self.pick_env(req) is not None
+        )
+
+    def reserve(self, req: VMRequirements, env_path: str) -> Tuple[float, ...]:
+        """
+        :return: ram of reserved gpus
+        """
+        self.free_vcpus -= req.smp
+        self.free_ram_mb -= req.ram_mb
+        self.env_free_mb[env_path] -= req.disk_mb
+        # smallest sufficient gpus, like allocator does
+        start = bisect_left(self.gpus, req.gpu_min_ram_mb)
+        gpus = tuple(self.gpus[start:start + req.gpu_count])
+        del self.gpus[start:start + req.gpu_count]
+        return gpus
+
+    def free(self, req: VMRequirements, env_path: str, gpus: Iterable[float]):
+        self.free_vcpus += req.smp
+        self.free_ram_mb += req.ram_mb
+        self.env_free_mb[env_path] += req.disk_mb
+        for ram_mb in gpus:
+            insort(self.gpus, ram_mb)
+
+
+Policy = Callable[['Scheduler', VMRequirements], Iterator[HostCapacity]]
+
+POLICIES: Dict[str, Policy] = {}
+
+
+def register_policy(name: str, policy: Policy):
+    """
+    :param policy: yields candidate hosts in preferred order, first fitting one is used
+    """
+    POLICIES[name] = policy
+
+
+def _most_ram(
+        scheduler: 'Scheduler', index: List[Tuple[float, str]], req: VMRequirements
+) -> Iterator[HostCapacity]:
+    start = bisect_left(index, (req.ram_mb, ''))
+    for i in range(len(index) - 1, start - 1, -1):
+        yield scheduler.hosts[index[i][1]]
+
+
+def _spread(scheduler: 'Scheduler', req: VMRequirements) -> Iterator[HostCapacity]:
+    # most free ram first
+    return _most_ram(scheduler, scheduler.by_ram, req)
+
+
+def _pack(scheduler: 'Scheduler', req: VMRequirements) -> Iterator[HostCapacity]:
+    # least free ram that is still enough
+    start = bisect_left(scheduler.by_ram, (req.ram_mb, ''))
+    for i in range(start, len(scheduler.by_ram)):
+        yield scheduler.hosts[scheduler.by_ram[i][1]]
+
+
+def _gpu_affinity(scheduler: 'Scheduler', req: VMRequirements) -> Iterator[HostCapacity]:
+    if req.gpu_count:
+        # fewest free gpus that are enough, keeps whole gpu hosts for big requests
+        start = bisect_left(scheduler.by_gpus, (req.gpu_count, ''))
+        for i in range(start, len(scheduler.by_gpus)):
+            yield scheduler.hosts[scheduler.by_gpus[i][1]]
+        return
+    # vms without gpus go to hosts without free gpus first
+    yield from _most_ram(scheduler, scheduler.by_ram_cpu_only, req)
+    yield from _most_ram(scheduler, scheduler.by_ram_gpu, req)
+
+
+register_policy('spread', _spread)
+register_policy('pack', _pack)
+register_policy('gpu-affinity', _gpu_affinity)
+
+
+class Scheduler:
+    """
+    Places vms on hosts by cached capacity,
+    hosts are indexed by free ram and free gpu count so decisions do not scan all hosts
+    """
+
+    def __init__(self, loader: ObjectLoader, policy: str = 'spread', cpu_overcommit: float = 1.):
+        self._loader = loader
+        self.policy = policy
+        self.cpu_overcommit = cpu_overcommit
+        self.hosts: Dict[str, HostCapacity] = {}
+        self.by_ram: List[Tuple[float, str]] = []
+        self.by_gpus: List[Tuple[int, str]] = []
+        # by_ram split by free gpus
+        self.by_ram_cpu_only: List[Tuple[float, str]] = []
+        self.by_ram_gpu: List[Tuple[float, str]] = []
+        self.placements: Dict[str, Placement] = {}
+        # placements by host path, then vm path, host refresh does not scan all vms
+        self.host_placements: Dict[str, Dict[str, Placement]] = {}
+
+    def _index_keys(self, capacity: HostCapacity) -> Tuple[Tuple[float, str], Tuple[int, str]]:
+        return (capacity.free_ram_mb, capacity.path), (len(capacity.gpus), capacity.path)
+
+    def _ram_index(self, capacity: HostCapacity) -> List[Tuple[float, str]]:
+        return self.by_ram_gpu if capacity.gpus else self.by_ram_cpu_only
+
+    def _unindex(self, capacity: HostCapacity):
+        ram_key, gpus_key = self._index_keys(capacity)
+        del self.by_ram[bisect_left(self.by_ram, ram_key)]
+        del self.by_gpus[bisect_left(self.by_gpus, gpus_key)]
+        ram_index = self._ram_index(capacity)
+        del ram_index[bisect_left(ram_index, ram_key)]
+
+    def _index(self, capacity: HostCapacity):
+        ram_key, gpus_key = self._index_keys(capacity)
+        insort(self.by_ram, ram_key)
+        insort(self.by_gpus, gpus_key)
+        insort(self._ram_index(capacity), ram_key)
+
+    def set_host(self, capacity: HostCapacity):
+        old = self.hosts.get(capacity.path)
+        if old is not None:
+            self._unindex(old)
+        self.hosts[capacity.path] = capacity
+        self._index(capacity)
+
+    def _children(self, path: str, cls) -> list:
+        if not isdir(path):
+            return []
+        return [obj for _, _, obj in self._loader.load_dir(path) if isinstance(obj, cls)]
+
+    def _is_pending(self, placement: Placement) -> bool:
+        vm = self._loader._loaded.get(placement.vm_path)
+        return vm is None or vm._state != 'started'
+
+    async def _host_capacity(self, host_path: str) -> HostCapacity:
+        host: Host = self._loader.load('.', host_path)
+        envs = self._children(host_path, Env)
+        await host.withstate('connected')
+        profile = await host.inventory.profile([env.dir for env in envs])
+        gpus = []
+        if exists(f'{host_path}/gpus.json'):
+            host_gpus: GPUS = self._loader.load('.', f'{host_path}/gpus')
+            gpus = [gpu.ram_mb for gpu in host_gpus.gpus() if not gpu.claimed_by]
+        capacity = HostCapacity(
+            host_path,
+            profile.cpus * self.cpu_overcommit,
+            profile.mem_available_mb,
+            gpus,
+            {env._current_path: profile.disks[env.dir].free_mb for env in envs if env.dir in profile.disks},
+        )
+        # running vms are already in profile, started ones keep their vcpus
+        for placement in self.host_placements.get(host_path, {}).values():
+            req = placement.requirements
+            if self._is_pending(placement):
+                capacity.reserve(req, placement.env_path)
+            else:
+                capacity.free_vcpus -= req.smp
+        return capacity
+
+    async def refresh(self, host_paths: Iterable[str]):
+        """
+        Load capacity of hosts from their inventory and gpu claims
+        """
+        for capacity in await gather(*(self._host_capacity(path) for path in host_paths)):
+            self.set_host(capacity)
+
+    def place(self, req: VMRequirements, policy: Optional[str] = None) -> Optional[Tuple[str, str]]:
+        """
+        :return: host path and env path, None when no host fits
+        """
+        for capacity in POLICIES[policy or self.policy](self, req):
+            if capacity.fits(req):
+                return capacity.path, capacity.pick_env(req)
+        return None
+
+    def commit(self, vm_path: str, req: VMRequirements, policy: Optional[str] = None) -> Placement:
+        """
+        Place and reserve resources until `release`
+        """
+        if vm_path in self.placements:
+            return self.placements[vm_path]
+        chosen = self.place(req, policy)
+        if chosen is None:
+            raise ValueError(f'No host fits {vm_path}: {req}')
+        host_path, env_path = chosen
+        capacity = self.hosts[host_path]
+        self._unindex(capacity)
+        gpus = capacity.reserve(req, env_path)
+        self._index(capacity)
+        placement = self.placements[vm_path] = Placement(vm_path, host_path, env_path, req, gpus)
+        self.host_placements.setdefault(host_path, {})[vm_path] = placement
+        return placement
+
+    def release(self, vm_path: str):
+        placement = self.placements.pop(vm_path, None)
+        if placement is None:
+            return
+        on_host = self.host_placements[placement.host_path]
+        del on_host[vm_path]
+        if not on_host:
+            del self.host_placements[placement.host_path]
+        capacity = self.hosts.get(placement.host_path)
+        if capacity is None:
+            return
+        self._unindex(capacity)
+        capacity.free(placement.requirements, placement.env_path, placement.gpus)
+        self._index(capacity)
@@ -0,0 +1,139 @@
+import json
+from asyncio import Future, Queue, ensure_future, get_running_loop, IncompleteReadError
+from itertools import count
+from typing import Optional, Dict, Any, List, Set, AsyncIterator
+
+
+class QMPError(Exception):
+    def __init__(self, cmd: str, error: Dict[str, Any]):
+        self.cmd = cmd
+        self.error_class = error.get('class', '')
+        self.desc = error.get('desc', '')
+        super().__init__(f'QMP command `{cmd}` failed: {self.error_class}: {self.desc}')
+
+
+class QMPClient:
+    """
+    QEMU monitor protocol over stream reader and writer,
+    requests are pipelined and matched to responses by id
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._ids = count()
+        self._pending: Dict[str, Future] = {}
+        self._subscribers: Set[Queue] = set()
+        self._read_task: Optional[Future] = None
+        self.greeting: Optional[Dict[str, Any]] = None
+        self.closed = False
+
+    async def connect(self):
+        self.greeting = await self._read_message()
+        self._read_task = ensure_future(self._read_loop())
+        await self.execute('qmp_capabilities')
+
+    async def _read_message(self) -> Dict[str, Any]:
+        line = await self._reader.readline()
+        if not line:
+            raise IncompleteReadError(b'', None)
+        return json.loads(line)
+
+    async def _read_loop(self):
+        error = None
+        try:
+            while True:
+                message = await self._read_message()
+                if 'event' in message:
+                    for queue in self._subscribers:
+                        queue.put_nowait(message)
+                    continue
+                fut = self._pending.pop(message.get('id'), None)
+                if fut is not None and not fut.done():
+                    fut.set_result(message)
+        except Exception as e:
+            error = e
+        finally:
+            self.closed = True
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError(f'QMP connection closed: {error}'))
+            self._pending.clear()
+            for queue in self._subscribers:
+                queue.put_nowait(None)
+
+    def send(self, cmd: str, arguments: Optional[Dict[str, Any]] = None) -> Future:
+        """
+        Write request without waiting for earlier responses
+        :return: future of response message
+        """
+        if self.closed:
+            raise ConnectionError('QMP connection closed')
+        request_id = str(next(self._ids))
+        request = {'execute': cmd, 'id': request_id}
+        if arguments:
+            request['arguments'] = arguments
+        fut = get_running_loop().create_future()
+        self._pending[request_id] = fut
+        self._writer.write(json.dumps(request).encode('utf-8') + b'\n')
+        return fut
+
+    async def execute(self, cmd: str, arguments: Optional[Dict[str, Any]] = None) -> Any:
+        fut = self.send(cmd, arguments)
+        await self._writer.drain()
+        response = await fut
+        if 'error' in response:
+            raise QMPError(cmd, response['error'])
+        return response.get('return')
+
+    async def execute_many(self, cmds: List[str]) -> List[Any]:
+        """
+        Send all commands in one write, results in order
+        """
+        futures = [self.send(cmd) for cmd in cmds]
+        await self._writer.drain()
+        results = []
+        for cmd, fut in zip(cmds, futures):
+            response = await fut
+            if 'error' in response:
+                raise QMPError(cmd, response['error'])
+            results.append(response.get('return'))
+        return results
+
+    def events(self, *names: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Events received from now on, all when `names` are not given
+        """
+        queue = Queue()
+        self._subscribers.add(queue)
+        return self._iter_events(queue, names)
+
+    async def _iter_events(self, queue: Queue, names) -> AsyncIterator[Dict[str, Any]]:
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    return
+                if not names or message['event'] in names:
+                    yield message
+        finally:
+            self._subscribers.discard(queue)
+
+    def wait_event(self, *names: str) -> Future:
+        """
+        Future of first event received from now on, None when connection closes before
+        """
+        return ensure_future(self._first_event(self.events(*names)))
+
+    @staticmethod
+    async def _first_event(events: AsyncIterator[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        async for message in events:
+            await events.aclose()
+            return message
+        return None
+
+    def close(self):
+        self.closed = True
+        if self._read_task is not None:
+            self._read_task.cancel()
+        self._writer.close()
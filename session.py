@@ -1,10 +1,29 @@
-from typing import Tuple
+from typing import Tuple, NamedTuple, Optional
+
+from gui import decode_data
 
 
 class CommandError(Exception):
     pass
 
 
+class CommandResult(NamedTuple):
+    cmd: str
+    exit_code: Optional[int]
+    stdout: bytes
+    stderr: bytes
+
+    def check(self) -> str:
+        if self.exit_code is None:
+            raise RuntimeError('Unknown error')
+        if self.exit_code:
+            raise CommandError(
+                f'Command `{self.cmd}` failed with code {self.exit_code}; '
+                f'stderr: {decode_data(self.stderr)}'
+            )
+        return decode_data(self.stdout)
+
+
 class Session:
     def execute(
             self, cmd, timeout=None, envs: Tuple[Tuple[str, str], ...] = ()
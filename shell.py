@@ -0,0 +1,150 @@
+from asyncio import Lock, gather
+from base64 import b64encode
+from shlex import quote
+from typing import Optional, Iterable, Tuple, List
+from uuid import uuid4
+
+from asyncssh import SSHClientProcess
+
+from session import CommandResult
+
+
+def new_marker() -> str:
+    return f'__vm_control_{uuid4().hex}'
+
+
+def frame_command(
+        cmd: str, marker: str, input: Optional[bytes] = None,
+        envs: Iterable[Tuple[str, str]] = ()
+) -> str:
+    """
+    Wrap command so its stdout, stderr and exit code can be cut out of a shared stream.
+    stdout ends with `\\n<marker> <exit code>\\n`, stderr ends with `\\n<marker>\\n`
+    """
+    exports = ''.join(f'export {k}={quote(v)}; ' for k, v in envs)
+    if input is None:
+        stdin_prefix = ''
+        stdin_redirect = '< /dev/null'
+    else:
+        stdin_prefix = f"printf %s '{b64encode(input).decode('ascii')}' | base64 -d | "
+        stdin_redirect = ''
+    return (
+        f'{stdin_prefix}( {exports}{cmd}\n) {stdin_redirect}\n'
+        f"printf '\\n{marker} %d\\n' $?\n"
+        f"printf '\\n{marker}\\n' >&2\n"
+    )
+
+
+def out_separator(marker: str) -> bytes:
+    return f'\n{marker} '.encode('ascii')
+
+
+def err_separator(marker: str) -> bytes:
+    return f'\n{marker}\n'.encode('ascii')
+
+
+class ShellClosedError(BrokenPipeError):
+    """
+    Shell was closed before command was written, command can be run elsewhere
+    """
+
+
+class RemoteShell:
+    def __init__(self, process: SSHClientProcess):
+        self._process = process
+        self._lock = Lock()
+        self.waiting = 0
+        self.closed = False
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    async def _read_out(self, marker: str) -> Tuple[int, bytes]:
+        sep = out_separator(marker)
+        data = await self._process.stdout.readuntil(sep)
+        exit_code = await self._process.stdout.readuntil(b'\n')
+        return int(exit_code.strip()), data[:-len(sep)]
+
+    async def _read_err(self, marker: str) -> bytes:
+        sep = err_separator(marker)
+        data = await self._process.stderr.readuntil(sep)
+        return data[:-len(sep)]
+
+    async def run(
+            self, cmd: str, input: Optional[bytes] = None,
+            envs: Iterable[Tuple[str, str]] = ()
+    ) -> CommandResult:
+        self.waiting += 1
+        try:
+            async with self._lock:
+                if self.closed:
+                    raise ShellClosedError('Shell closed')
+                marker = new_marker()
+                try:
+                    self._process.stdin.write(
+                        frame_command(cmd, marker, input, envs).encode('utf-8')
+                    )
+                except OSError as e:
+                    self.close()
+                    raise ShellClosedError(f'Shell closed: {e}') from e
+                try:
+                    (exit_code, stdout), stderr = await gather(
+                        self._read_out(marker), self._read_err(marker)
+                    )
+                except BaseException:
+                    # shell is left in the middle of a command
+                    self.close()
+                    raise
+        finally:
+            self.waiting -= 1
+
+        return CommandResult(cmd, exit_code, stdout, stderr)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._process.close()
+
+
+def frame_batch(
+        cmds: Iterable[str], envs: Iterable[Tuple[str, str]] = ()
+) -> Tuple[str, List[str]]:
+    markers = []
+    script = ''
+    for cmd in cmds:
+        marker = new_marker()
+        markers.append(marker)
+        script += frame_command(cmd, marker, envs=envs)
+    return script, markers
+
+
+def split_batch(
+        cmds: Iterable[str], markers: Iterable[str], stdout: bytes, stderr: bytes
+) -> List[CommandResult]:
+    results = []
+    out_pos = 0
+    err_pos = 0
+    for cmd, marker in zip(cmds, markers):
+        out_sep = out_separator(marker)
+        err_sep = err_separator(marker)
+        out_end = stdout.find(out_sep, out_pos)
+        err_end = stderr.find(err_sep, err_pos)
+        if out_end < 0:
+            # batch was interrupted before the command finished
+            results.append(CommandResult(cmd, None, stdout[out_pos:], stderr[err_pos:]))
+            out_pos = len(stdout)
+            err_pos = len(stderr)
+            continue
+
+        code_start = out_end + len(out_sep)
+        code_end = stdout.find(b'\n', code_start)
+        exit_code = int(stdout[code_start:code_end])
+        if err_end < 0:
+            err_end = len(stderr)
+        results.append(CommandResult(
+            cmd, exit_code, stdout[out_pos:out_end], stderr[err_pos:err_end]
+        ))
+        out_pos = code_end + 1
+        err_pos = min(err_end + len(err_sep), len(stderr))
+    return results
@@ -0,0 +1,141 @@
+from asyncio import get_running_loop
+from hashlib import sha256
+from os import stat
+from typing import Dict, Tuple, TYPE_CHECKING, List
+from uuid import uuid4
+
+from session import CommandError
+
+if TYPE_CHECKING:
+    from host import Host
+
+STORE_PREFIX = 'store:'
+
+_MISSING_EXIT_CODE = 3
+
+_local_digests: Dict[Tuple[str, int, int], str] = {}
+
+
+def _file_digest(fname: str, chunk_size: int = int(2 ** 22)) -> str:
+    h = sha256()
+    with open(fname, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+async def local_digest(fname: str) -> str:
+    """
+    sha256 of local file, remembered until file size or mtime changes
+    """
+    st = stat(fname)
+    key = (fname, st.st_size, st.st_mtime_ns)
+    digest = _local_digests.get(key)
+    if digest is None:
+        digest = await get_running_loop().run_in_executor(None, _file_digest, fname)
+        _local_digests[key] = digest
+    return digest
+
+
+class ContentStore:
+    """
+    Per-host store of files named by their sha256.
+    Blobs are read-only, envs get reflinks (or copies) of them, never hard links
+    because env files are written in place.
+    Env dirs are fscrypt-encrypted and reflinks cannot cross into them, so linking
+    into an env is a full copy there; blobs themselves are stored as they are in `store_dir`,
+    which has to be on encrypted storage too, see `Host.store_encrypted`.
+    Blobs with other hard links (refs of drives) are never evicted.
+    """
+
+    def __init__(self, host: 'Host', store_dir: str, budget_mb: float = 0.):
+        self._host = host
+        self.store_dir = store_dir.rstrip('/')
+        self.budget_mb = budget_mb
+
+    def blob_path(self, digest: str) -> str:
+        return f'{self.store_dir}/blobs/{digest[:2]}/{digest}'
+
+    def ref_path(self, digest: str, ref_name: str) -> str:
+        return f'{self.store_dir}/refs/{digest}.{ref_name}'
+
+    def tmp_path(self, digest: str) -> str:
+        return f'{self.store_dir}/tmp/{digest}.{uuid4().hex}'
+
+    async def prepare(self, digest: str):
+        await self._host.run_command(
+            f'mkdir -p "{self.store_dir}/blobs/{digest[:2]}" "{self.store_dir}/refs" "{self.store_dir}/tmp"',
+            invalidates=(self.store_dir,)
+        )
+
+    def add_ref_cmd(self, digest: str, ref_name: str) -> str:
+        return f'mkdir -p "{self.store_dir}/refs" && ln -f "{self.blob_path(digest)}" "{self.ref_path(digest, ref_name)}"'
+
+    def remove_ref_cmd(self, digest: str, ref_name: str) -> str:
+        return f'rm -f "{self.ref_path(digest, ref_name)}"'
+
+    async def link_into(self, digest: str, dst_path: str) -> bool:
+        """
+        Put blob at `dst_path`, return False when store has no such blob.
+        Reflinked where filesystem allows it, copied otherwise (always into fscrypt dirs)
+        """
+        blob = self.blob_path(digest)
+        try:
+            await self._host.run_command(
+                f'( [ -f "{blob}" ] || exit {_MISSING_EXIT_CODE} ) && touch -c "{blob}" && rm -f "{dst_path}" && '
+                f'cp --reflink=auto --sparse=always "{blob}" "{dst_path}" && chmod u+w "{dst_path}"',
+                invalidates=(dst_path,)
+            )
+        except CommandError as e:
+            if f'failed with code {_MISSING_EXIT_CODE};' in str(e):
+                return False
+            raise
+        return True
+
+    async def add(self, tmp_path: str, digest: str):
+        blob = self.blob_path(digest)
+        await self._host.run_command(
+            f'chmod 444 "{tmp_path}" && mv -f "{tmp_path}" "{blob}"',
+            invalidates=(blob,)
+        )
+
+    async def list_blobs(self) -> List[Tuple[float, int, int, str]]:
+        """
+        (mtime, link count, size, path) of every blob
+        """
+        out = await self._host.run_command(
+            f'[ -d "{self.store_dir}/blobs" ] || exit 0; '
+            f'find "{self.store_dir}/blobs" -type f -printf "%T@ %n %s %p\\n"'
+        )
+        blobs = []
+        for line in out.splitlines():
+            mtime, links, size, path = line.split(' ', 3)
+            blobs.append((float(mtime), int(links), int(size), path))
+        return blobs
+
+    async def evict(self) -> List[str]:
+        """
+        Remove least recently used unreferenced blobs until store fits in budget
+        """
+        if self.budget_mb <= 0:
+            return []
+        blobs = await self.list_blobs()
+        budget = self.budget_mb * 2 ** 20
+        total = sum(size for _, _, size, _ in blobs)
+        evicted = []
+        for _, links, size, path in sorted(blobs):
+            if total <= budget:
+                break
+            if links > 1:
+                continue
+            evicted.append(path)
+            total -= size
+        if evicted:
+            await self._host.run_command(
+                'rm -f ' + ' '.join(f'"{path}"' for path in evicted),
+                invalidates=evicted
+            )
+        return evicted
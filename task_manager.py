@@ -2,11 +2,12 @@ from asyncio import create_task, set_event_loop, AbstractEventLoop, run_coroutin
 from functools import partial
 from inspect import isasyncgen
 from time import perf_counter
+from threading import Lock
 from traceback import print_exception
-from typing import Optional
+from typing import Optional, Dict
 
 from async_ import make_thread_loop
-from gui import Gtk, gtk_func
+from gui import Gtk, gtk_func, global_gtk_loop
 
 
 class Task:
@@ -46,13 +47,17 @@ class Task:
     def set_task(self, coro):
         self.task = create_task(self._wrap_task(coro))
 
-    @gtk_func
     def set_progress(self, progress: float):
+        update_bus.set_progress(self, progress)
+
+    def set_message(self, msg: str):
+        update_bus.set_message(self, msg)
+
+    def _show_progress(self, progress: float):
         if self.progress_bar is not None:
             self.progress_bar.set_fraction(progress)
 
-    @gtk_func
-    def set_message(self, msg: str):
+    def _show_message(self, msg: str):
         # TODO: history / log ?
         if self.msg_label is not None:
             self.msg_label.set_label(msg)
@@ -67,6 +72,49 @@ class Task:
             self.on_cancel()
 
 
+class UpdateBus:
+    """
+    Keeps only latest progress and message of every task,
+    they are shown in one GTK callback at most `fps` times per second
+    """
+
+    def __init__(self, fps: float = 20.):
+        self.interval = 1. / fps
+        self._lock = Lock()
+        self._progress: Dict[Task, float] = {}
+        self._messages: Dict[Task, str] = {}
+        self._scheduled = False
+        self._last_flush = 0.
+
+    def set_progress(self, task: Task, progress: float):
+        with self._lock:
+            self._progress[task] = progress
+            self._schedule()
+
+    def set_message(self, task: Task, msg: str):
+        with self._lock:
+            self._messages[task] = msg
+            self._schedule()
+
+    def _schedule(self):
+        if self._scheduled:
+            return
+        self._scheduled = True
+        delay = max(self._last_flush + self.interval - perf_counter(), 0.)
+        global_gtk_loop.call_soon_threadsafe(global_gtk_loop.call_later, delay, self._flush)
+
+    def _flush(self):
+        with self._lock:
+            progress, self._progress = self._progress, {}
+            messages, self._messages = self._messages, {}
+            self._scheduled = False
+            self._last_flush = perf_counter()
+        for task, value in progress.items():
+            task._show_progress(value)
+        for task, msg in messages.items():
+            task._show_message(msg)
+
+
 class TaskManager:
     def __init__(self):
         self.tasks = []
@@ -96,6 +144,7 @@ def _start_background_loop(loop: AbstractEventLoop) -> None:
     loop.run_forever()
 
 
+update_bus = UpdateBus()
 global_task_manager = TaskManager()
 global_task_manager_loop = make_thread_loop()
 
@@ -0,0 +1,34 @@
+import json
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+from fanout import FanOut
+from host import LocalHost
+from loader import ObjectLoader
+
+
+class FanOutTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._dir = TemporaryDirectory()
+        os.chdir(self._dir.name)
+        os.makedirs('test')
+        for name in ('a', 'b'):
+            with open(f'test/{name}.json', 'w') as f:
+                json.dump({'class_name': LocalHost.__name__}, f)
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._dir.cleanup()
+
+    async def test_run(self):
+        fan_out = FanOut(ObjectLoader(), ['test/a', 'test/b', 'test/missing'], 'echo ok')
+        results = {res.path: res async for res in fan_out.run()}
+        self.assertEqual(results['test/a'].output, 'ok\n')
+        self.assertEqual(results['test/b'].output, 'ok\n')
+        self.assertIsInstance(fan_out.failures['test/missing'], FileNotFoundError)
+        self.assertTrue(fan_out.report().startswith('2/3 hosts ok; failed: test/missing'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+from asyncio import sleep, gather, ensure_future, get_running_loop
+
+from host import SSHConnectionPool
+
+
+class FakeProcess:
+    def __init__(self):
+        self.closed = get_running_loop().create_future()
+
+    async def wait_closed(self):
+        await self.closed
+
+
+class FakeConnection:
+    async def create_process(self, *a, **k):
+        return FakeProcess()
+
+    def close(self):
+        pass
+
+
+class SSHConnectionPoolTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.opened = []
+
+    async def open_connection(self):
+        await sleep(.01)
+        conn = FakeConnection()
+        self.opened.append(conn)
+        return conn
+
+    async def test_single_flight_connect(self):
+        pool = SSHConnectionPool(self.open_connection, 2)
+        await gather(*(pool.connect() for _ in range(10)))
+        self.assertEqual(len(self.opened), 2)
+
+    async def test_short_commands_share_host_cap(self):
+        pool = SSHConnectionPool(self.open_connection, 1, max_channels=10)
+        running = []
+
+        async def short():
+            async with pool.channel():
+                running.append(1)
+                self.assertLessEqual(len(running), 10)
+                await sleep(.01)
+                running.pop()
+
+        await gather(*(short() for _ in range(50)))
+        self.assertEqual(len(self.opened), 1)
+
+    async def test_long_running_processes_grow_pool(self):
+        pool = SSHConnectionPool(self.open_connection, 1, max_channels=10, max_connections=3)
+        processes = [await pool.create_process('qemu') for _ in range(10)]
+        async with pool.channel() as conn:
+            self.assertIs(conn, self.opened[1])
+        processes += [await pool.create_process('qemu') for _ in range(20)]
+        self.assertEqual(len(self.opened), 3)
+
+        waiting = ensure_future(pool.create_process('qemu'))
+        await sleep(.05)
+        self.assertFalse(waiting.done())
+        processes[0].closed.set_result(None)
+        await sleep(.01)
+        self.assertTrue(waiting.done())
+
+
+if __name__ == '__main__':
+    unittest.main()
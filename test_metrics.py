@@ -0,0 +1,85 @@
+import unittest
+from math import isnan
+
+from metrics import MetricsCollector, TimeSeries, parse_sample, VM_FIELDS
+
+
+def stat_line(pid: int, comm: str, utime: int, stime: int) -> str:
+    # fields after comm: state, then 10 fields before utime and stime
+    return f'stat {pid} ({comm}) S 1 {pid} {pid} 0 -1 4194560 100 0 0 0 {utime} {stime} 0 0 20 0 5 0'
+
+
+def sample_output(t: float, utime: int, read_bytes: int, rx: int) -> str:
+    return '\n'.join([
+        f'time {t}',
+        'hz 100',
+        'pid 42',
+        'cmd qemu-system-x86_64\t-name\tdb vm,debug-threads=on\t-qmp\tunix:/vms/db/qmp.sock,server,wait=off\t',
+        stat_line(42, 'qemu) (x 86', utime, 50),
+        'status VmRSS:\t  2048 kB',
+        'status Threads:\t5',
+        f'io read_bytes: {read_bytes}',
+        'io write_bytes: 0',
+        'cgmem 4096',
+        f'net tap0 {rx} 10',
+        f'net tap1 {rx} 10',
+        'pid 43',
+        stat_line(43, 'qemu-system-x86', 7, 3),
+        'stat broken',
+    ])
+
+
+class ParseSampleTest(unittest.TestCase):
+    def test_parse(self):
+        t, hz, processes = parse_sample(sample_output(10.5, 150, 1000, 100))
+        self.assertEqual((t, hz), (10.5, 100))
+        first, second = processes
+        self.assertEqual((first.pid, first.name, first.key), (42, 'db vm', '/vms/db/qmp.sock'))
+        # comm with spaces and parentheses does not shift stat fields
+        self.assertEqual(first.cpu_ticks, 200)
+        self.assertEqual(first.rss, 2048 * 1024)
+        self.assertEqual((first.read_bytes, first.write_bytes), (1000, 0))
+        self.assertEqual(first.cgroup_mem, 4096.)
+        self.assertEqual((first.net_rx, first.net_tx), (200, 20))
+        # bad line is skipped, earlier values stay
+        self.assertEqual((second.pid, second.key, second.cpu_ticks), (43, '43', 10))
+        self.assertTrue(isnan(second.cgroup_mem))
+
+
+class FakeHost:
+    def __init__(self, outputs):
+        self.outputs = list(outputs)
+        self.quiet = []
+
+    async def run_command(self, cmd, quiet=False, **k):
+        self.quiet.append(quiet)
+        return self.outputs.pop(0)
+
+
+class MetricsCollectorTest(unittest.IsolatedAsyncioTestCase):
+    async def test_rates(self):
+        host = FakeHost([sample_output(10., 150, 1000, 100), sample_output(12., 350, 5000, 300)])
+        collector = MetricsCollector(host, capacity=4)
+        self.assertEqual(await collector.sample(), {})
+        rates = await collector.sample()
+        values = rates['/vms/db/qmp.sock']
+        self.assertEqual(values['cpu'], 100.)
+        self.assertEqual(values['disk_read'], 2000.)
+        self.assertEqual(values['net_rx'], 200.)
+        self.assertEqual(len(collector.series['/vms/db/qmp.sock']), 1)
+        self.assertEqual(collector.names['/vms/db/qmp.sock'], 'db vm')
+        self.assertEqual(host.quiet, [True, True])
+
+
+class TimeSeriesTest(unittest.TestCase):
+    def test_wraps(self):
+        series = TimeSeries(VM_FIELDS, 3)
+        for i in range(5):
+            series.append(float(i), {'cpu': i * 10.})
+        self.assertEqual(list(series.times()), [2., 3., 4.])
+        self.assertEqual(list(series.values('cpu')), [20., 30., 40.])
+        self.assertTrue(isnan(series.last()['rss']))
+
+
+if __name__ == '__main__':
+    unittest.main()
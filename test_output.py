@@ -0,0 +1,89 @@
+import unittest
+
+from host import LocalHost
+from output import OutputBuffer, ProcessOutput
+
+
+def fill(buffer: OutputBuffer, count: int, start: int = 0):
+    for i in range(start, start + count):
+        buffer.feed('err' if i % 3 == 0 else 'out', f'line {i}\n'.encode())
+
+
+class OutputBufferTest(unittest.TestCase):
+    def setUp(self):
+        # 10 lines in memory, spooled in segments of 4, so some lines are always pending
+        self.buffer = OutputBuffer(max_lines=10, segment_lines=4)
+
+    def tearDown(self):
+        self.buffer.close()
+
+    def test_spooled_segments(self):
+        fill(self.buffer, 35)
+        self.assertEqual(self.buffer.line_count, 35)
+        self.assertEqual(len(self.buffer._lines), 10)
+        self.assertEqual([first for first, _ in self.buffer._segments], [0, 4, 8, 12, 16, 20])
+        self.assertEqual(len(self.buffer._pending), 1)
+
+    def test_range_across_spool_pending_and_memory(self):
+        fill(self.buffer, 35)
+        for start, stop in ((0, 35), (3, 9), (6, 27), (24, 26), (25, 30), (33, 100)):
+            lines = self.buffer.range(start, stop)
+            self.assertEqual(
+                [(line.number, line.text) for line in lines],
+                [(i, f'line {i}') for i in range(start, min(stop, 35))]
+            )
+        self.assertEqual(self.buffer.range(20, 20), [])
+        self.assertEqual(self.buffer.range(0, 1)[0].stream, 'err')
+
+    def test_tail_and_last_line(self):
+        self.assertEqual(self.buffer.last_line, '')
+        fill(self.buffer, 35)
+        self.assertEqual([line.number for line in self.buffer.tail(3)], [32, 33, 34])
+        self.assertEqual([line.number for line in self.buffer.tail(100)], list(range(35)))
+        self.assertEqual(self.buffer.last_line, 'line 34')
+
+    def test_search(self):
+        fill(self.buffer, 35)
+        self.assertEqual([line.number for line in self.buffer.search(r'line 1\d')], list(range(10, 20)))
+        self.assertEqual([line.number for line in self.buffer.search(r'line 1', limit=2)], [1, 10])
+        self.assertEqual([line.number for line in self.buffer.search(r'line', stream='err', limit=3)], [0, 3, 6])
+
+    def test_partial_and_long_lines(self):
+        buffer = OutputBuffer(max_line_bytes=4)
+        buffer.feed('out', b'ab')
+        buffer.feed('err', b'x\n')
+        buffer.feed('out', b'c\nabcdefghij')
+        self.assertEqual([(line.stream, line.text) for line in buffer.tail()], [
+            ('err', 'x'), ('out', 'abc'), ('out', 'abcd'), ('out', 'efgh'),
+        ])
+        buffer.flush()
+        self.assertEqual(buffer.last_line, 'ij')
+
+    def test_without_spool(self):
+        buffer = OutputBuffer(max_lines=10, spool=False)
+        fill(buffer, 35)
+        self.assertEqual(buffer.dropped, 25)
+        self.assertEqual([line.number for line in buffer.range(0)], list(range(25, 35)))
+
+    def test_close_keeps_memory_lines(self):
+        fill(self.buffer, 35)
+        self.buffer.close()
+        self.assertEqual([line.number for line in self.buffer.range(0)], list(range(25, 35)))
+        self.assertEqual(self.buffer.last_line, 'line 34')
+
+
+class ProcessOutputTest(unittest.IsolatedAsyncioTestCase):
+    async def test_run_closes_spool(self):
+        host = LocalHost('test/local', None, {})
+        process = await host.create_process('seq 1 50; echo done >&2; exit 4')
+        buffer = OutputBuffer(max_lines=10, segment_lines=4)
+        output = ProcessOutput(process, buffer)
+        self.assertEqual(await output.run(), 4)
+        self.assertIsNone(buffer._spool)
+        self.assertEqual(buffer.line_count, 51)
+        self.assertEqual(buffer.search('done')[0].stream, 'err')
+        self.assertTrue(output.last_line in ('done', '50'))
+
+
+if __name__ == '__main__':
+    unittest.main()
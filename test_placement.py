@@ -0,0 +1,108 @@
+import unittest
+
+from loader import ObjectLoader
+from placement import Scheduler, HostCapacity, VMRequirements
+from vm import QemuVM, DriveImage
+
+
+def make_scheduler(policy: str = 'spread') -> Scheduler:
+    scheduler = Scheduler(ObjectLoader(), policy)
+    scheduler.set_host(HostCapacity('hosts/small', 8, 4096, (), {'hosts/small/env': 100000}))
+    scheduler.set_host(HostCapacity('hosts/big', 32, 65536, (), {'hosts/big/env': 100000}))
+    scheduler.set_host(HostCapacity('hosts/gpu1', 16, 32768, (8192,), {'hosts/gpu1/env': 100000}))
+    scheduler.set_host(HostCapacity('hosts/gpu4', 64, 131072, (8192, 8192, 16384, 24576), {
+        'hosts/gpu4/env': 100000, 'hosts/gpu4/fast': 200000,
+    }))
+    return scheduler
+
+
+class PolicyTest(unittest.TestCase):
+    def test_spread(self):
+        scheduler = make_scheduler('spread')
+        self.assertEqual(scheduler.place(VMRequirements(2, 2048)), ('hosts/gpu4', 'hosts/gpu4/fast'))
+
+    def test_pack(self):
+        scheduler = make_scheduler('pack')
+        self.assertEqual(scheduler.place(VMRequirements(2, 2048))[0], 'hosts/small')
+        self.assertEqual(scheduler.place(VMRequirements(2, 8192))[0], 'hosts/gpu1')
+        # enough ram but too few vcpus
+        self.assertEqual(scheduler.place(VMRequirements(12, 2048))[0], 'hosts/gpu1')
+
+    def test_gpu_affinity(self):
+        scheduler = make_scheduler('gpu-affinity')
+        self.assertEqual(scheduler.place(VMRequirements(2, 2048))[0], 'hosts/big')
+        self.assertEqual(scheduler.place(VMRequirements(2, 2048, gpu_count=1))[0], 'hosts/gpu1')
+        self.assertEqual(scheduler.place(VMRequirements(2, 2048, gpu_count=1, gpu_min_ram_mb=16000))[0], 'hosts/gpu4')
+        self.assertEqual(scheduler.place(VMRequirements(2, 2048, gpu_count=2))[0], 'hosts/gpu4')
+
+    def test_no_fit(self):
+        scheduler = make_scheduler()
+        self.assertIsNone(scheduler.place(VMRequirements(2, 2 ** 20)))
+        self.assertIsNone(scheduler.place(VMRequirements(2, 1024, disk_mb=300000)))
+        self.assertIsNone(scheduler.place(VMRequirements(2, 1024, gpu_count=5)))
+        with self.assertRaises(ValueError):
+            scheduler.commit('vms/huge', VMRequirements(2, 2 ** 20))
+
+
+class IndexTest(unittest.TestCase):
+    def assertIndexed(self, scheduler: Scheduler):
+        hosts = scheduler.hosts.values()
+        self.assertEqual(scheduler.by_ram, sorted((c.free_ram_mb, c.path) for c in hosts))
+        self.assertEqual(scheduler.by_gpus, sorted((len(c.gpus), c.path) for c in hosts))
+        self.assertEqual(scheduler.by_ram_gpu, sorted((c.free_ram_mb, c.path) for c in hosts if c.gpus))
+        self.assertEqual(scheduler.by_ram_cpu_only, sorted((c.free_ram_mb, c.path) for c in hosts if not c.gpus))
+        by_host = {}
+        for placement in scheduler.placements.values():
+            by_host.setdefault(placement.host_path, {})[placement.vm_path] = placement
+        self.assertEqual(scheduler.host_placements, by_host)
+
+    def test_commit_and_release(self):
+        scheduler = make_scheduler('gpu-affinity')
+        gpu1 = scheduler.hosts['hosts/gpu1']
+        placement = scheduler.commit('vms/a', VMRequirements(4, 16384, 1000, 1))
+        self.assertEqual((placement.host_path, placement.gpus), ('hosts/gpu1', (8192.,)))
+        self.assertEqual((gpu1.free_vcpus, gpu1.free_ram_mb, gpu1.gpus), (12, 16384, []))
+        self.assertEqual(gpu1.env_free_mb['hosts/gpu1/env'], 99000)
+        self.assertIndexed(scheduler)
+        self.assertIs(scheduler.commit('vms/a', VMRequirements(1, 1)), placement)
+        self.assertEqual(scheduler.commit('vms/b', VMRequirements(2, 1024)).host_path, 'hosts/big')
+        self.assertEqual(scheduler.commit('vms/c', VMRequirements(2, 60000)).host_path, 'hosts/big')
+        # host without free gpus now takes cpu only vms
+        self.assertEqual(scheduler.commit('vms/d', VMRequirements(2, 10000)).host_path, 'hosts/gpu1')
+        self.assertIndexed(scheduler)
+
+        scheduler.release('vms/a')
+        scheduler.release('vms/d')
+        scheduler.release('vms/missing')
+        self.assertEqual((gpu1.free_vcpus, gpu1.free_ram_mb, gpu1.gpus), (16, 32768, [8192.]))
+        self.assertEqual(gpu1.env_free_mb['hosts/gpu1/env'], 100000)
+        self.assertNotIn('hosts/gpu1', scheduler.host_placements)
+        self.assertIndexed(scheduler)
+
+    def test_refreshed_host_replaces_index(self):
+        scheduler = make_scheduler()
+        scheduler.set_host(HostCapacity('hosts/small', 8, 1024, (4096,), {}))
+        self.assertEqual(len(scheduler.hosts), 4)
+        self.assertIndexed(scheduler)
+
+
+class RequirementsTest(unittest.TestCase):
+    def test_of_vm(self):
+        loader = ObjectLoader()
+        loader._loaded['test/disk'] = DriveImage('test/disk', loader, dict(
+            path='disk.qcow2', format='qcow2', size_mb=10240
+        ))
+        loader._loaded['test/overlay'] = DriveImage('test/overlay', loader, dict(
+            path='overlay.qcow2', format='qcow2', size_mb=10240, base_img_path='base.qcow2'
+        ))
+        loader._loaded['test/iso'] = DriveImage('test/iso', loader, dict(
+            path='a.iso', mode='cdrom-ro', format='iso-ro', size_mb=700
+        ))
+        vm = QemuVM('test/vm', loader, dict(
+            smp=4, ram_mb=8192, drives='../disk, ../overlay,../iso', gpu_count=1, gpu_min_ram_mb=8000
+        ))
+        self.assertEqual(VMRequirements.of_vm(vm), VMRequirements(4, 8192, 10240, 1, 8000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import json
+import unittest
+from asyncio import start_unix_server, open_unix_connection, wait_for, sleep
+from tempfile import TemporaryDirectory
+
+from qmp import QMPClient, QMPError
+
+
+class FakeQMPServer:
+    """
+    Answers requests only after `batch` of them arrived, so responses are sent out of order
+    """
+
+    def __init__(self, batch: int = 1):
+        self.batch = batch
+        self.requests = []
+        self.writers = []
+
+    async def handle(self, reader, writer):
+        self.writers.append(writer)
+        writer.write(b'{"QMP": {"version": {}, "capabilities": []}}\n')
+        waiting = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            request = json.loads(line)
+            self.requests.append(request)
+            if request['execute'] == 'qmp_capabilities':
+                writer.write(json.dumps({'return': {}, 'id': request['id']}).encode() + b'\n')
+                continue
+            waiting.append(request)
+            if len(waiting) < self.batch:
+                continue
+            for request in reversed(waiting):
+                writer.write(json.dumps(self.respond(request)).encode() + b'\n')
+            waiting = []
+        writer.close()
+
+    def respond(self, request):
+        if request['execute'] == 'fail':
+            return {'error': {'class': 'GenericError', 'desc': 'failed'}, 'id': request['id']}
+        return {'return': {'cmd': request['execute'], 'args': request.get('arguments')}, 'id': request['id']}
+
+    def emit(self, event: str):
+        for writer in self.writers:
+            writer.write(json.dumps({'event': event, 'data': {}}).encode() + b'\n')
+
+    def disconnect(self):
+        for writer in self.writers:
+            writer.close()
+
+
+class QMPClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._dir = TemporaryDirectory()
+        self.path = f'{self._dir.name}/qmp.sock'
+        self.fake = FakeQMPServer()
+        self.server = await start_unix_server(lambda r, w: self.fake.handle(r, w), self.path)
+        self.client = QMPClient(*await open_unix_connection(self.path))
+        await self.client.connect()
+
+    async def asyncTearDown(self):
+        self.client.close()
+        self.server.close()
+        await self.server.wait_closed()
+        self._dir.cleanup()
+
+    async def test_greeting_and_capabilities(self):
+        self.assertIn('QMP', self.client.greeting)
+        self.assertEqual(self.fake.requests[0]['execute'], 'qmp_capabilities')
+
+    async def test_execute(self):
+        result = await self.client.execute('balloon', {'value': 1024})
+        self.assertEqual(result, {'cmd': 'balloon', 'args': {'value': 1024}})
+
+    async def test_pipelined_out_of_order(self):
+        self.fake.batch = 3
+        results = await wait_for(self.client.execute_many(['a', 'b', 'c']), 5)
+        self.assertEqual([r['cmd'] for r in results], ['a', 'b', 'c'])
+
+    async def test_error_response(self):
+        with self.assertRaises(QMPError) as e:
+            await self.client.execute('fail')
+        self.assertEqual(e.exception.error_class, 'GenericError')
+        self.assertEqual(e.exception.desc, 'failed')
+        # connection is still usable
+        self.assertEqual((await self.client.execute('ok'))['cmd'], 'ok')
+
+    async def test_wait_event(self):
+        shutdown = self.client.wait_event('SHUTDOWN')
+        await sleep(0)
+        self.fake.emit('RESUME')
+        self.fake.emit('SHUTDOWN')
+        event = await wait_for(shutdown, 5)
+        self.assertEqual(event['event'], 'SHUTDOWN')
+        self.assertFalse(self.client._subscribers)
+
+    async def test_disconnect(self):
+        shutdown = self.client.wait_event('SHUTDOWN')
+        self.fake.batch = 2
+        pending = self.client.send('never')
+        await self.client._writer.drain()
+        await sleep(.05)
+        self.fake.disconnect()
+        with self.assertRaises(ConnectionError):
+            await wait_for(pending, 5)
+        self.assertIsNone(await wait_for(shutdown, 5))
+        self.assertTrue(self.client.closed)
+        with self.assertRaises(ConnectionError):
+            self.client.send('late')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+from asyncio import gather, sleep
+
+from host import LocalHost, SSHHost
+from shell import RemoteShell, ShellClosedError, frame_batch, split_batch, out_separator, err_separator
+
+
+class RemoteShellTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.host = LocalHost('test/local', None, {})
+        self.shell = RemoteShell(await self.host.create_process('sh'))
+
+    async def asyncTearDown(self):
+        self.shell.close()
+        await self.shell._process.wait_closed()
+
+    async def test_exit_code_and_streams(self):
+        res = await self.shell.run('echo out; echo err >&2; exit 3')
+        self.assertEqual(res.exit_code, 3)
+        self.assertEqual(res.stdout, b'out\n')
+        self.assertEqual(res.stderr, b'err\n')
+
+    async def test_no_trailing_newline(self):
+        res = await self.shell.run('printf out; printf err >&2')
+        self.assertEqual((res.stdout, res.stderr), (b'out', b'err'))
+
+    async def test_input_and_envs(self):
+        res = await self.shell.run('cat; printf "$A"', input=b'in\x00put\n', envs=[('A', "it's")])
+        self.assertEqual(res.stdout, b"in\x00put\nit's")
+
+    async def test_shell_state_is_not_shared(self):
+        await self.shell.run('cd /; X=1')
+        res = await self.shell.run('printf "$X"')
+        self.assertEqual(res.stdout, b'')
+
+    async def test_sequential_and_concurrent(self):
+        results = await gather(*(self.shell.run(f'echo {i}') for i in range(20)))
+        self.assertEqual([res.stdout for res in results], [f'{i}\n'.encode() for i in range(20)])
+
+    async def test_queued_commands_fail_retryable(self):
+        killed, queued = await gather(
+            self.shell.run('kill -9 $$'), self.shell.run('echo queued'), return_exceptions=True
+        )
+        self.assertNotIsInstance(killed, ShellClosedError)
+        self.assertIsInstance(queued, ShellClosedError)
+        self.assertTrue(self.shell.closed)
+
+
+class PersistentShellTest(unittest.IsolatedAsyncioTestCase):
+    async def test_one_shell_per_connection(self):
+        local = LocalHost('test/local', None, {})
+        host = SSHHost('test/ssh', None, dict(host='localhost', connections=1, persistent_shell=True))
+        created = []
+
+        async def create_process(cmd, *a, **k):
+            created.append(cmd)
+            await sleep(.01)
+            return await local.create_process(cmd, *a, **k)
+
+        host.create_process = create_process
+        results = await gather(*(host._exec(f'echo {i}') for i in range(20)))
+        self.assertEqual([res.stdout for res in results], [f'{i}\n'.encode() for i in range(20)])
+        self.assertEqual(created, ['sh'])
+        for shell in host._shells:
+            shell.close()
+            await shell._process.wait_closed()
+
+
+class BatchTest(unittest.IsolatedAsyncioTestCase):
+    def framed(self, markers, outputs):
+        stdout = b''
+        stderr = b''
+        for marker, (out, err, code) in zip(markers, outputs):
+            stdout += out + out_separator(marker) + f'{code}\n'.encode()
+            stderr += err + err_separator(marker)
+        return stdout, stderr
+
+    def test_split(self):
+        cmds = ['a', 'b', 'c']
+        _, markers = frame_batch(cmds)
+        stdout, stderr = self.framed(markers, [(b'1', b'', 0), (b'', b'e2\n', 2), (b'3\n', b'e3', 0)])
+        results = split_batch(cmds, markers, stdout, stderr)
+        self.assertEqual(
+            [(r.cmd, r.exit_code, r.stdout, r.stderr) for r in results],
+            [('a', 0, b'1', b''), ('b', 2, b'', b'e2\n'), ('c', 0, b'3\n', b'e3')]
+        )
+
+    def test_interrupted(self):
+        cmds = ['a', 'b', 'c']
+        _, markers = frame_batch(cmds)
+        stdout, stderr = self.framed(markers[:1], [(b'1', b'e1', 0)])
+        results = split_batch(cmds, markers, stdout + b'partial', stderr + b'err')
+        self.assertEqual(
+            [(r.exit_code, r.stdout, r.stderr) for r in results],
+            [(0, b'1', b'e1'), (None, b'partial', b'err'), (None, b'', b'')]
+        )
+
+    def test_missing_stderr_marker(self):
+        # stdout of command is complete, its stderr was cut
+        cmds = ['a', 'b']
+        _, markers = frame_batch(cmds)
+        stdout, stderr = self.framed(markers, [(b'1', b'e1', 0), (b'2', b'e2', 0)])
+        stderr = stderr[:stderr.index(err_separator(markers[1]))]
+        results = split_batch(cmds, markers, stdout, stderr)
+        self.assertEqual([(r.stdout, r.stderr) for r in results], [(b'1', b'e1'), (b'2', b'e2')])
+
+    async def test_run_batch(self):
+        host = LocalHost('test/local', None, {})
+        results = await host.run_batch([
+            'echo one; echo err >&2', 'exit 5', 'printf "$A"', 'cat', 'kill -9 $$', 'echo after',
+        ], envs=[('A', 'env')])
+        self.assertEqual(
+            [(r.exit_code, r.stdout, r.stderr) for r in results[:4]],
+            [(0, b'one\n', b'err\n'), (5, b'', b''), (0, b'env', b''), (0, b'', b'')]
+        )
+        # killed batch shell leaves rest of batch without exit code
+        self.assertEqual([r.exit_code for r in results[4:]], [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
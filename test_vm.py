@@ -0,0 +1,104 @@
+import unittest
+
+from vm import QemuVM, DriveImage, parse_cpu_list
+
+
+def make_vm(**data) -> QemuVM:
+    return QemuVM('test/vm', None, data)
+
+
+def make_drive(**data) -> DriveImage:
+    return DriveImage('test/drive', None, dict(path='disk.qcow2', format='qcow2', **data))
+
+
+class BuildCommandTest(unittest.TestCase):
+    def test_default(self):
+        cmd = make_vm(name='vm1', ram_mb=2048).build_command([], '/run/vm1.qmp')
+        self.assertTrue(cmd.startswith('qemu-system-x86_64 -name "vm1"'))
+        self.assertIn('-m "2048.0M"', cmd)
+        self.assertIn('-qmp "unix:/run/vm1.qmp,server=on,wait=off"', cmd)
+        self.assertIn('-device "virtio-balloon-pci"', cmd)
+        self.assertNotIn('memory-backend', cmd)
+        self.assertNotIn('taskset', cmd)
+
+    def test_memory_backend(self):
+        cmd = make_vm(
+            ram_mb=4096, memory_backend='hugepages', mem_prealloc=True, numa_node=1, smp=2
+        ).build_command([])
+        self.assertIn('-machine "type=pc,accel=kvm,memory-backend=mem0"', cmd)
+        self.assertIn('-m "4096M"', cmd)
+        self.assertIn(
+            '-object "memory-backend-file,id=mem0,size=4096M,mem-path=/dev/hugepages,share=on,'
+            'prealloc=on,prealloc-threads=2,host-nodes=1,policy=bind"', cmd
+        )
+
+    def test_drives_and_iothreads(self):
+        drives = [(make_drive(), '/env/a.qcow2'), (make_drive(cache='none', aio='native'), '/env/b.qcow2')]
+        cmd = make_vm(iothreads=2, disk_queues=2).build_command(drives)
+        self.assertIn('-object "iothread,id=io0" -object "iothread,id=io1"', cmd)
+        self.assertIn('file=/env/b.qcow2,format=qcow2,if=none,id=drive1,cache=none,aio=native', cmd)
+        self.assertIn('-device "virtio-blk-pci,drive=drive0,num-queues=2,iothread=io0"', cmd)
+        self.assertIn('-device "virtio-blk-pci,drive=drive1,num-queues=2,iothread=io1"', cmd)
+
+    def test_scsi(self):
+        cmd = make_vm(disk_bus='virtio-scsi', iothreads=1).build_command([(make_drive(), '/env/a.qcow2')])
+        self.assertIn('-device "virtio-scsi-pci,id=scsi0,iothread=io0"', cmd)
+        self.assertIn('-device "scsi-hd,drive=drive0,bus=scsi0.0"', cmd)
+
+    def test_cdrom(self):
+        drive = DriveImage('test/iso', None, dict(path='a.iso', mode='cdrom-ro', format='iso-ro'))
+        cmd = make_vm().build_command([(drive, '/env/a.iso')])
+        self.assertIn('-drive "file=/env/a.iso,media=cdrom,readonly=on"', cmd)
+
+    def test_tap_multiqueue(self):
+        cmd = make_vm(net='tap', net_ifname='tap0', net_queues=4).build_command([])
+        self.assertIn('-netdev "tap,id=net0,ifname=tap0,script=no,downscript=no,vhost=on,queues=4"', cmd)
+        self.assertIn('-device "virtio-net-pci,netdev=net0,mq=on,vectors=10"', cmd)
+
+    def test_pinning_and_gpus(self):
+        cmd = make_vm(smp=2, cpu_pinning='2-3').build_command([], gpu_ids=['00000000:0A:00.0'])
+        self.assertTrue(cmd.startswith('taskset -c 2-3 qemu-system-x86_64'))
+        self.assertIn('-device "vfio-pci,host=0000:0a:00.0"', cmd)
+
+
+class ValidateTest(unittest.TestCase):
+    def assertInvalid(self, message: str, **data):
+        with self.assertRaises(ValueError) as e:
+            make_vm(**data).build_command([])
+        self.assertIn(message, str(e.exception))
+
+    def test_valid(self):
+        make_vm(net='tap', net_ifname='tap0', net_queues=2, iothreads=1, disk_queues=2).validate()
+
+    def test_invalid(self):
+        self.assertInvalid('cpu_pinning has 2 cpus for smp 4', cpu_pinning='0-1')
+        self.assertInvalid('cpu_pinning: Invalid cpu range', cpu_pinning='3-1')
+        self.assertInvalid('numa_node must be', numa_node=-2)
+        self.assertInvalid('whole MB', ram_mb=1000.5, memory_backend='memfd')
+        self.assertInvalid('multiple of 2 MB', ram_mb=1001, memory_backend='hugepages')
+        self.assertInvalid('mem_prealloc needs', mem_prealloc=True)
+        self.assertInvalid('need virtio', virtio=False, iothreads=1)
+        self.assertInvalid('disk_queues 8 more than smp 4', disk_queues=8)
+        self.assertInvalid('tap net needs net_ifname', net='tap')
+        self.assertInvalid('net_queues > 1 needs tap', net='user', net_queues=2)
+        self.assertInvalid('gpu_count must not be negative', gpu_count=-1)
+
+    def test_errors_are_joined(self):
+        with self.assertRaises(ValueError) as e:
+            make_vm(net='tap', gpu_count=-1).validate()
+        self.assertEqual(
+            str(e.exception), 'test/vm: tap net needs net_ifname; gpu_count must not be negative'
+        )
+
+    def test_drive_aio(self):
+        with self.assertRaises(ValueError):
+            make_drive(aio='native').validate()
+        make_drive(aio='native', cache='directsync').validate()
+
+    def test_parse_cpu_list(self):
+        self.assertEqual(parse_cpu_list('0-2, 5,7-8'), [0, 1, 2, 5, 7, 8])
+        self.assertEqual(parse_cpu_list(''), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
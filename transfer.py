@@ -0,0 +1,447 @@
+import gzip
+import lzma
+from asyncio import get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from errno import ENXIO
+from functools import partial
+from hashlib import sha256
+from os import SEEK_DATA, SEEK_HOLE, lseek, pread, cpu_count
+from os.path import exists
+from shlex import quote
+from time import perf_counter
+from typing import List, Tuple, Iterator, Iterable, NamedTuple, Callable, Dict, Optional
+
+from task_manager import Task
+
+
+def _format_speed(bps: float):
+    if bps < 1024.:
+        return f'{bps:.1f} B/s'
+    bps /= 1024.
+    if bps < 1024.:
+        return f'{bps:.1f} KB/s'
+    bps /= 1024.
+    return f'{bps:.1f} MB/s'
+
+
+def _format_seconds(secs: float):
+    secs = int(secs)
+    tm = f'{secs % 60:02}s'
+    secs //= 60
+    if not secs:
+        return tm
+    tm = f'{secs % 60:02}:' + tm
+    secs //= 60
+    if not secs:
+        return tm
+    tm = f'{secs}:' + tm
+    return tm
+
+
+class TransferProgress:
+    """
+    Progress and speed of one transfer, shared by all its streams
+    """
+
+    def __init__(
+            self, task: Task, total: int, report_interval: float = 20.,
+            progress_interval: float = .2
+    ):
+        self._task = task
+        self.total = total
+        self.done = 0
+        self._report_interval = report_interval
+        self._progress_interval = progress_interval
+        self._last_progress = 0.
+        self._start_time = perf_counter()
+        self._last_meas = self._start_time
+        self._last_done = 0
+
+    def add(self, count: int):
+        self.done += count
+        new_meas = perf_counter()
+        if self.total and new_meas - self._last_progress > self._progress_interval:
+            self._task.set_progress(min(self.done / self.total, 1.))
+            self._last_progress = new_meas
+        if new_meas - self._last_meas > self._report_interval:
+            left = max(self.total - self.done, 0)
+            current_speed = max((self.done - self._last_done) / (new_meas - self._last_meas), 1e-3)
+            overall_speed = max(self.done / (new_meas - self._start_time), 1e-3)
+            self._task.set_message(
+                f'Current speed: {_format_speed(current_speed)}'
+                f'({_format_seconds(left / current_speed)} left) '
+                f'Overall speed: {_format_speed(overall_speed)}'
+                f'({_format_seconds(left / overall_speed)} left)'
+            )
+            self._last_meas = new_meas
+            self._last_done = self.done
+
+    def set_message(self, msg: str):
+        self._task.set_message(msg)
+
+    def finish(self):
+        self._task.set_progress(1.)
+
+
+def data_extents(fd: int, size: int) -> List[Tuple[int, int]]:
+    """
+    (offset, count) ranges of file which hold data, holes are skipped
+    falls back to whole file when filesystem cannot report holes
+    """
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                if e.errno == ENXIO:  # only hole till the end
+                    break
+                raise
+            end = min(lseek(fd, start, SEEK_HOLE), size)
+            if end > start:
+                extents.append((start, end - start))
+            offset = end
+    except OSError:
+        return [(0, size)] if size else []
+    return extents
+
+
+def split_extents(
+        extents: List[Tuple[int, int]], streams: int, align: int = int(2 ** 16)
+) -> List[List[Tuple[int, int]]]:
+    """
+    Divide extents into at most `streams` groups with similar byte count
+    """
+    total = sum(count for _, count in extents)
+    group_size = -(-total // max(streams, 1))
+    group_size = max(-(-group_size // align) * align, align)
+    groups = []
+    group = []
+    group_left = group_size
+    for offset, count in extents:
+        while count:
+            part = min(count, group_left)
+            group.append((offset, part))
+            offset += part
+            count -= part
+            group_left -= part
+            if not group_left:
+                groups.append(group)
+                group = []
+                group_left = group_size
+    if group:
+        groups.append(group)
+    return groups
+
+
+_zero_block = bytes(int(2 ** 16))
+
+
+def nonzero_runs(data, block: int = int(2 ** 16), min_hole: int = 0) -> Iterator[Tuple[int, int]]:
+    """
+    (start, end) ranges of data which are not made of zero blocks,
+    zero gaps shorter than `min_hole` are kept inside ranges
+    """
+    view = memoryview(data)
+    zero = memoryview(_zero_block)[:block]
+    run_start = None
+    run_end = 0
+    for start in range(0, len(view), block):
+        chunk = view[start:start + block]
+        if chunk == zero[:len(chunk)]:
+            continue
+        if run_start is not None and start - run_end >= max(min_hole, 1):
+            yield run_start, run_end
+            run_start = None
+        if run_start is None:
+            run_start = start
+        run_end = start + len(chunk)
+    if run_start is not None:
+        yield run_start, run_end
+
+
+class Codec(NamedTuple):
+    name: str
+    compress: Callable[[bytes], bytes]
+    remote_decompress: str
+    remote_compress: str
+
+
+CODECS: Dict[str, Codec] = {}
+
+
+def register_codec(
+        name: str, compress: Callable[[bytes], bytes], remote_decompress: str,
+        remote_compress: str
+):
+    """
+    :param name: shell-safe name sent in frame headers
+    :param compress: compresses one chunk, called in worker threads
+    :param remote_decompress: remote command decompressing one chunk from stdin to stdout
+    :param remote_compress: remote command compressing stdin to stdout
+    """
+    CODECS[name] = Codec(name, compress, remote_decompress, remote_compress)
+
+
+register_codec('gzip', partial(gzip.compress, compresslevel=1), 'gzip -dc', 'gzip -1 -c')
+register_codec('xz', partial(lzma.compress, preset=0), 'xz -dc', 'xz -0 -c')
+
+
+class ChunkSizer:
+    """
+    Grows chunk size while writes drain quickly, shrinks it when drain waits too long.
+    Remote writer starts a `dd` per frame, so frames stay at least `min_size` large
+    unless `max_size` is smaller
+    """
+
+    def __init__(
+            self, max_size: int, min_size: int = int(2 ** 22),
+            target_latency: float = .05
+    ):
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.size = self.min_size
+        self._target_latency = target_latency
+
+    def observe_drain(self, seconds: float, buffered: int = 0):
+        if seconds > self._target_latency:
+            self.size = max(self.size // 2, self.min_size)
+        elif seconds < self._target_latency / 4 and not buffered:
+            self.size = min(self.size * 2, self.max_size)
+
+
+def read_frames(
+        view: memoryview, extents: List[Tuple[int, int]],
+        sizer: ChunkSizer, skip_zeros: bool
+) -> Iterator[Tuple[int, memoryview, int]]:
+    """
+    Yield (offset, data, read bytes) frames to send, data are slices of mapped file
+    """
+    empty = view[:0]
+    for offset, count in extents:
+        end = offset + count
+        while offset < end:
+            data = view[offset:min(end, offset + sizer.size)]
+            if skip_zeros:
+                # zero blocks stay holes in preallocated file
+                read_count = len(data)
+                for start, stop in nonzero_runs(data, min_hole=int(2 ** 20)):
+                    yield offset + start, data[start:stop], read_count
+                    read_count = 0
+                if read_count:
+                    # only zeros, nothing to send
+                    yield offset, empty, read_count
+            else:
+                yield offset, data, len(data)
+            offset += len(data)
+
+
+def frame_header(offset: int, count: int, codec: str = 'raw') -> bytes:
+    return f'{offset} {count} {codec}\n'.encode('ascii')
+
+
+def remote_writer_cmd(path: str) -> str:
+    """
+    Remote command writing frames `<offset> <count> <codec>\\n<data>` from stdin into existing file
+    """
+    read_frame = 'dd bs=1048576 iflag=fullblock,count_bytes count="$len" status=none'
+    write_frame = 'dd of="$F" bs=1048576 oflag=seek_bytes seek="$off" conv=notrunc status=none'
+    codec_cases = ''.join(
+        f'{codec.name}) {read_frame} | {codec.remote_decompress} | {write_frame} || exit 1 ;; '
+        for codec in CODECS.values()
+    )
+    script = (
+        f'F="{path}"; '
+        f'while read -r off len codec; do '
+        f'case "$codec" in {codec_cases}'
+        f'*) dd of="$F" bs=1048576 iflag=fullblock,count_bytes count="$len" '
+        f'oflag=seek_bytes seek="$off" conv=notrunc status=none || exit 1 ;; '
+        f'esac; '
+        f'done'
+    )
+    return f'sh -c {quote(script)}'
+
+
+_compress_workers = cpu_count() or 1
+_compress_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_compress_executor() -> ThreadPoolExecutor:
+    global _compress_executor
+    if _compress_executor is None:
+        _compress_executor = ThreadPoolExecutor(_compress_workers, thread_name_prefix='compress')
+    return _compress_executor
+
+
+class AdaptiveCompressor:
+    """
+    Compresses chunks while it speeds transfer up.
+    Ratio and cpu time are measured on first chunks (and again every `reprobe_every` chunks)
+    and compared with link speed seen while sending.
+    """
+
+    def __init__(
+            self, codec: Codec, probe_chunks: int = 8,
+            reprobe_every: int = 256, min_gain: float = .1
+    ):
+        self.codec = codec
+        self._executor = _get_compress_executor()
+        self.workers = _compress_workers
+        self._probe_chunks = probe_chunks
+        self._reprobe_every = max(reprobe_every, probe_chunks + 1)
+        self._min_gain = min_gain
+        self.enabled = True
+        self._chunks = 0
+        self._raw_bytes = 0
+        self._packed_bytes = 0
+        self._cpu_time = 0.
+        self._sent_bytes = 0
+        self._send_time = 0.
+
+    def observe_send(self, count: int, seconds: float):
+        self._sent_bytes += count
+        self._send_time += seconds
+
+    def _decide(self):
+        ratio = self._packed_bytes / max(self._raw_bytes, 1)
+        if self._send_time > 0. and self._sent_bytes:
+            link_speed = self._sent_bytes / self._send_time
+            compress_speed = self._raw_bytes / max(self._cpu_time, 1e-9) * self.workers
+            effective_speed = min(compress_speed, link_speed / max(ratio, 1e-9))
+            self.enabled = effective_speed > link_speed * (1. + self._min_gain)
+        else:
+            self.enabled = ratio < 1. - self._min_gain
+        print(f'{self.codec.name} ratio {ratio:.2f}, compression {"on" if self.enabled else "off"}')
+        self._raw_bytes = 0
+        self._packed_bytes = 0
+        self._cpu_time = 0.
+        self._sent_bytes = 0
+        self._send_time = 0.
+
+    async def encode(self, data: bytes) -> Tuple[str, bytes]:
+        probing = self._chunks % self._reprobe_every < self._probe_chunks
+        self._chunks += 1
+        if not (probing or self.enabled):
+            return 'raw', data
+
+        start = perf_counter()
+        packed = await get_running_loop().run_in_executor(self._executor, self.codec.compress, data)
+        if probing:
+            self._raw_bytes += len(data)
+            self._packed_bytes += len(packed)
+            self._cpu_time += perf_counter() - start
+            if self._chunks % self._reprobe_every == self._probe_chunks:
+                self._decide()
+
+        if len(packed) >= len(data):
+            return 'raw', data
+        return self.codec.name, packed
+
+
+def remote_allocate_cmd(path: str, size: int) -> str:
+    return f': > "{path}" && truncate -s {size} "{path}"'
+
+
+def remote_resize_cmd(path: str, size: int) -> str:
+    return f'truncate -s {size} "{path}"'
+
+
+def remote_block_hashes_cmd(path: str, block_size: int) -> str:
+    """
+    Remote command printing `size <bytes>` and then `<block index> <sha256>` for every block
+    """
+    script = (
+        f'F="{path}"; '
+        f'[ -f "$F" ] || {{ echo "size -1"; exit 0; }}; '
+        f'size=$(stat -c %s "$F") && echo "size $size" && '
+        f'n=$(( (size + {block_size} - 1) / {block_size} )) && i=0 && '
+        f'while [ $i -lt $n ]; do '
+        f'echo "$i $(dd if="$F" bs={block_size} skip=$i count=1 status=none | sha256sum | cut -d" " -f1)"; '
+        f'i=$((i + 1)); '
+        f'done'
+    )
+    return f'sh -c {quote(script)}'
+
+
+def block_hash(fd: int, offset: int, count: int) -> str:
+    return sha256(pread(fd, count, offset)).hexdigest()
+
+
+def blocks_to_extents(
+        blocks: Iterable[int], block_size: int, size: int
+) -> List[Tuple[int, int]]:
+    """
+    Merge sorted block indexes into (offset, count) extents
+    """
+    extents = []
+    for i in blocks:
+        offset = i * block_size
+        count = min(block_size, size - offset)
+        if extents and extents[-1][0] + extents[-1][1] == offset:
+            extents[-1] = (extents[-1][0], extents[-1][1] + count)
+        else:
+            extents.append((offset, count))
+    return extents
+
+
+def read_resume_log(fname: str, source_id: str) -> Dict[int, Tuple[int, str]]:
+    """
+    Blocks completed by earlier download, log starts with source id line
+    followed by `<offset> <count> <sha256>` line of every completed block
+    :return: count and digest by offset, empty when source changed
+    """
+    if not exists(fname):
+        return {}
+    with open(fname, 'r') as f:
+        lines = f.read().split('\n')
+    if lines[0] != source_id:
+        return {}
+    blocks = {}
+    # last line is empty or cut by crash
+    for line in lines[1:-1]:
+        parts = line.split(' ')
+        if len(parts) == 3 and parts[0].isdigit() and parts[1].isdigit():
+            blocks[int(parts[0])] = (int(parts[1]), parts[2])
+    return blocks
+
+
+def remote_read_cmd(path: str, offset: int, count: int) -> str:
+    return (
+        f'dd if="{path}" bs=65536 iflag=skip_bytes,count_bytes '
+        f'skip={offset} count={count} status=none'
+    )
+
+
+def remote_range_digest_cmd(path: str, offset: int, count: int) -> str:
+    return f'{remote_read_cmd(path, offset, count)} | sha256sum | cut -d" " -f1'
+
+
+def remote_source_cmd(path: str, codec: Optional[str] = None) -> str:
+    """
+    Remote command sending whole file to stdout, compressed when `codec` is given.
+    Compressor reads the file itself, so read errors are not hidden by a pipeline
+    """
+    if codec:
+        return f'{CODECS[codec].remote_compress} < "{path}"'
+    return f'dd if="{path}" bs=65536 status=none'
+
+
+def remote_sink_cmd(path: str, size: int, codec: Optional[str] = None, sparse: bool = True) -> str:
+    """
+    Remote command writing stdin from `remote_source_cmd` into file,
+    zero blocks are left as holes when `sparse`
+    """
+    conv = 'sparse,notrunc' if sparse else 'notrunc'
+    write = f'dd of="{path}" bs=65536 iflag=fullblock conv={conv} status=none'
+    if codec:
+        write = f'{CODECS[codec].remote_decompress} | {write}'
+    return f': > "{path}" && {write} && truncate -s {size} "{path}"'
+
+
+def remote_size_cmd(path: str) -> str:
+    return f'stat -c %s "{path}" 2> /dev/null || echo -1'
+
+
+def remote_digest_cmd(path: str) -> str:
+    return f'sha256sum "{path}" | cut -d" " -f1'
@@ -1,7 +1,20 @@
-from typing import Optional
+from asyncio import gather, get_running_loop, sleep, wait_for, shield, ensure_future, TimeoutError
+from hashlib import sha256
+from collections import defaultdict
+from typing import Optional, Iterable, List, Tuple, Dict, Any, TYPE_CHECKING
 
-from gui import ConfigObject, StrField, IntField, FloatField, SelectField, EnField, StateChange
-from host import SSHProcess
+from asyncssh import Error as SSHError
+
+from gpu import sysfs_pci_id, vfio_bind_cmd
+from gui import ConfigObject, StrField, IntField, FloatField, SelectField, EnField, StateChange, withstates
+from metrics import TimeSeries
+from output import ProcessOutput
+from qmp import QMPClient
+from session import CommandResult
+from store import STORE_PREFIX
+
+if TYPE_CHECKING:
+    from env import Env
 
 
 class ShellCommand:
@@ -19,6 +32,24 @@ class ShellCommand:
         return self.cmd
 
 
+def parse_cpu_list(cpus: str) -> List[int]:
+    """
+    :param cpus: list in taskset format, e.g. `2-5,8`
+    """
+    result = []
+    for part in cpus.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        first = int(first)
+        last = int(last) if last else first
+        if first < 0 or last < first:
+            raise ValueError(f'Invalid cpu range {part}')
+        result.extend(range(first, last + 1))
+    return result
+
+
 class QemuVM(ConfigObject):
     dir: str = StrField(default='.')
     name: str = StrField(default='test')
@@ -27,35 +58,286 @@ class QemuVM(ConfigObject):
     smp: int = IntField(default=4)
     vga: int = StrField(default='virtio')
     ram_mb: float = FloatField(default=1024.)
-    net: str = SelectField(values=('none',))
+    net: str = SelectField(values=('none', 'user', 'tap'))
+    net_ifname: str = StrField(default='')
+    net_vhost: bool = EnField(default=True)
+    net_queues: int = IntField(default=1)
     virtio: bool = EnField(default=True)
+    disk_bus: str = SelectField(values=('virtio-blk', 'virtio-scsi'))
+    disk_queues: int = IntField(default=0)
+    iothreads: int = IntField(default=0)
     drives: str = StrField(default='')
+    cpu_pinning: str = StrField(default='')
+    numa_node: int = IntField(default=-1)
+    memory_backend: str = SelectField(values=('default', 'hugepages', 'memfd'))
+    hugepages_path: str = StrField(default='/dev/hugepages')
+    mem_prealloc: bool = EnField(default=False)
+    shutdown_timeout: float = FloatField(default=60.)
+    gpus: str = StrField(default='$host/gpus')
+    gpu_count: int = IntField(default=0)
+    gpu_min_ram_mb: float = FloatField(default=0.)
+    gpu_driver_override: bool = EnField(default=False)
 
     def __init__(self, current_path: str, loader: 'ObjectLoader', data):
         super().__init__(current_path, loader, data)
-        self._process: Optional[SSHProcess] = None
+        self.output: Optional[ProcessOutput] = None
+        self._qmp: Optional[QMPClient] = None
 
-    @StateChange('loaded', 'started')
-    async def start(self):
-        cmd = ShellCommand(f'qemu-system-{self.arch}') \
+    def validate(self):
+        errors = []
+        try:
+            pinned = parse_cpu_list(self.cpu_pinning)
+            if pinned and len(pinned) < self.smp:
+                errors.append(f'cpu_pinning has {len(pinned)} cpus for smp {self.smp}')
+        except ValueError as e:
+            errors.append(f'cpu_pinning: {e}')
+        if self.numa_node < -1:
+            errors.append('numa_node must be -1 (unbound) or node number')
+        if (self.memory_backend != 'default' or self.numa_node >= 0) and self.ram_mb != int(self.ram_mb):
+            # backend size must equal -m size
+            errors.append('ram_mb must be whole MB with memory backend or numa_node')
+        if self.memory_backend == 'hugepages' and int(self.ram_mb) % 2:
+            errors.append('ram_mb must be multiple of 2 MB for hugepages')
+        if self.mem_prealloc and self.memory_backend == 'default' and self.numa_node < 0:
+            errors.append('mem_prealloc needs memory_backend or numa_node')
+        if self.iothreads < 0 or self.disk_queues < 0:
+            errors.append('iothreads and disk_queues must not be negative')
+        if (self.iothreads or self.disk_queues) and not self.virtio:
+            errors.append('iothreads and disk_queues need virtio')
+        if self.disk_queues > self.smp:
+            errors.append(f'disk_queues {self.disk_queues} more than smp {self.smp}')
+        if self.net == 'tap' and not self.net_ifname:
+            errors.append('tap net needs net_ifname')
+        if self.net_queues < 1:
+            errors.append('net_queues must be at least 1')
+        if self.net_queues > 1 and (self.net != 'tap' or not self.net_vhost):
+            errors.append('net_queues > 1 needs tap net with vhost')
+        if self.net_queues > self.smp:
+            errors.append(f'net_queues {self.net_queues} more than smp {self.smp}')
+        if self.gpu_count < 0:
+            errors.append('gpu_count must not be negative')
+        if errors:
+            raise ValueError(f'{self._current_path}: ' + '; '.join(errors))
+
+    def _memory_backend_args(self) -> Optional[str]:
+        size = f'size={int(self.ram_mb)}M'
+        if self.memory_backend == 'hugepages':
+            args = f'memory-backend-file,id=mem0,{size},mem-path={self.hugepages_path},share=on'
+        elif self.memory_backend == 'memfd':
+            args = f'memory-backend-memfd,id=mem0,{size},share=on'
+        elif self.numa_node >= 0:
+            args = f'memory-backend-ram,id=mem0,{size}'
+        else:
+            return None
+        if self.mem_prealloc:
+            args += f',prealloc=on,prealloc-threads={self.smp}'
+        if self.numa_node >= 0:
+            args += f',host-nodes={self.numa_node},policy=bind'
+        return args
+
+    def _add_drives(self, cmd: ShellCommand, drive_params: List[Tuple['DriveImage', str]]):
+        queues = f',num-queues={self.disk_queues}' if self.disk_queues else ''
+        if self.virtio and self.disk_bus == 'virtio-scsi':
+            iothread = ',iothread=io0' if self.iothreads else ''
+            scsi_queues = f',num_queues={self.disk_queues}' if self.disk_queues else ''
+            cmd.a('device', f'virtio-scsi-pci,id=scsi0{scsi_queues}{iothread}')
+        for i, (drive, path) in enumerate(drive_params):
+            if not self.virtio or drive.mode != 'drive':
+                cmd.a('drive', drive.mount_params(path))
+                continue
+            drive_id = f'drive{i}'
+            cmd.a('drive', drive.mount_params(path, drive_id))
+            if self.disk_bus == 'virtio-scsi':
+                cmd.a('device', f'scsi-hd,drive={drive_id},bus=scsi0.0')
+            else:
+                # drives are spread over iothreads
+                iothread = f',iothread=io{i % self.iothreads}' if self.iothreads else ''
+                cmd.a('device', f'virtio-blk-pci,drive={drive_id}{queues}{iothread}')
+
+    def _add_net(self, cmd: ShellCommand):
+        if self.net == 'user':
+            cmd.a('netdev', 'user,id=net0')
+            cmd.a('device', 'virtio-net-pci,netdev=net0')
+        elif self.net == 'tap':
+            netdev = f'tap,id=net0,ifname={self.net_ifname},script=no,downscript=no'
+            device = 'virtio-net-pci,netdev=net0'
+            if self.net_vhost:
+                netdev += ',vhost=on'
+            if self.net_queues > 1:
+                netdev += f',queues={self.net_queues}'
+                device += f',mq=on,vectors={2 * self.net_queues + 2}'
+            cmd.a('netdev', netdev)
+            cmd.a('device', device)
+
+    def qmp_path(self, env: 'Env') -> str:
+        return env.format_path(f'{self.dir}/{self.name}.qmp')
+
+    def build_command(
+            self, drive_params: List[Tuple['DriveImage', str]], qmp_path: Optional[str] = None,
+            gpu_ids: Iterable[str] = ()
+    ) -> str:
+        """
+        Qemu command line, does not touch host
+        :param drive_params: drives with their paths on host
+        :param qmp_path: unix socket of monitor
+        :param gpu_ids: pci bus ids of passed through gpus
+        """
+        self.validate()
+        prefix = f'taskset -c {self.cpu_pinning} ' if self.cpu_pinning else ''
+        machine = 'type=pc,accel=kvm'
+        memory = self._memory_backend_args()
+        if memory is not None:
+            machine += ',memory-backend=mem0'
+        cmd = ShellCommand(f'{prefix}qemu-system-{self.arch}') \
             .a('name', self.name) \
             .a('enable-kvm') \
-            .a('machine', 'type=pc,accel=kvm') \
+            .a('machine', machine) \
             .a('smp', self.smp) \
             .a('vga', self.vga) \
             .a('nographic') \
-            .a('m', f'{self.ram_mb}M') \
+            .a('m', f'{int(self.ram_mb) if memory is not None else self.ram_mb}M') \
             .a('usb') \
-            .a('device', 'usb-tablet')
-        if self.virtio:
-            cmd.a('device', 'virtio-scsi-pci')
-        for d in self.drives.split(','):
-            d = d.strip()
-            if d:
-                cmd.a('drive', await (await self.o(d).withstate('created')).get_mount_params())
+            .a('device', 'usb-tablet') \
+            .a('device', 'virtio-balloon-pci')
+        if qmp_path:
+            cmd.a('qmp', f'unix:{qmp_path},server=on,wait=off')
+        if memory is not None:
+            cmd.a('object', memory)
+        for i in range(self.iothreads):
+            cmd.a('object', f'iothread,id=io{i}')
+        self._add_drives(cmd, drive_params)
+        self._add_net(cmd)
+        for gpu_id in gpu_ids:
+            cmd.a('device', f'vfio-pci,host={sysfs_pci_id(gpu_id)}')
+        return cmd.cmd
+
+    @StateChange('loaded', 'started')
+    async def start(self):
+        drives = [self.o(d.strip()) for d in self.drives.split(',') if d.strip()]
+        self.validate()
+        for drive in drives:
+            drive.validate()
+        # env unlock and drive creation overlap, they wait only for shared transitions
+        env, _ = await gather(self.get_env(), DriveImage.create_all(drives))
+        await withstates(*((drive, 'created') for drive in drives))
+        paths = await gather(*(drive.get_path() for drive in drives))
+        # monitor socket is created by qemu in vm dir
+        await env.ensure_path(self.dir)
+        qmp_path = self.qmp_path(env)
+        if len(qmp_path.encode('utf-8')) >= 108:
+            raise ValueError(f'{self._current_path}: monitor socket path {qmp_path} longer than 107 bytes')
+
+        gpu_ids = []
+        if self.gpu_count:
+            gpus = await self.o(self.gpus).allocate(
+                self._current_path, self.gpu_count, self.gpu_min_ram_mb
+            )
+            gpu_ids = [gpu.name for gpu in gpus]
+        try:
+            if gpu_ids and self.gpu_driver_override:
+                for res in await env.run_batch([vfio_bind_cmd(gpu_id) for gpu_id in gpu_ids]):
+                    res.check()
+            self.output = await env.start_process(
+                self.build_command(list(zip(drives, paths)), qmp_path, gpu_ids)
+            )
+        except BaseException:
+            if gpu_ids:
+                await self.o(self.gpus).release(self._current_path)
+            raise
+        if self.cpu_pinning:
+            await self.pin_vcpus()
+
+    async def qmp(self, timeout: float = 10.) -> QMPClient:
+        """
+        Monitor connection, socket is awaited for `timeout` after qemu start
+        """
+        if self._qmp is not None and not self._qmp.closed:
+            return self._qmp
+        env = await self.get_env()
+        host = await self.get_host()
+        path = self.qmp_path(env)
+        deadline = get_running_loop().time() + timeout
+        while True:
+            try:
+                reader, writer = await host.open_unix_connection(path)
+                break
+            except (OSError, SSHError):
+                if get_running_loop().time() > deadline:
+                    raise
+                await sleep(.2)
+        client = QMPClient(reader, writer)
+        try:
+            await client.connect()
+        except BaseException:
+            client.close()
+            raise
+        self._qmp = client
+        return client
+
+    async def status(self) -> Dict[str, Any]:
+        return await (await self.qmp()).execute('query-status')
+
+    async def pause(self):
+        await (await self.qmp()).execute('stop')
+
+    async def resume(self):
+        await (await self.qmp()).execute('cont')
+
+    async def powerdown(self):
+        await (await self.qmp()).execute('system_powerdown')
 
+    async def balloon(self, ram_mb: float):
+        await (await self.qmp()).execute('balloon', {'value': int(ram_mb * 2 ** 20)})
+
+    async def query_blockstats(self) -> List[Dict[str, Any]]:
+        return await (await self.qmp()).execute('query-blockstats')
+
+    async def metrics(self) -> Optional[TimeSeries]:
+        """
+        Rates sampled by host metrics collector, see `Host.watch_metrics`
+        """
+        env = await self.get_env()
+        return (await self.get_host()).metrics.series.get(self.qmp_path(env))
+
+    async def pin_vcpus(self):
+        """
+        Pin every vCPU thread to its own cpu from `cpu_pinning`
+        """
+        cpus = parse_cpu_list(self.cpu_pinning)
+        vcpus = await (await self.qmp()).execute('query-cpus-fast')
         env = await self.get_env()
-        await env.start_process(cmd.cmd)
+        results = await env.run_batch([
+            f'taskset -pc {cpus[vcpu["cpu-index"] % len(cpus)]} {vcpu["thread-id"]}'
+            for vcpu in vcpus
+        ])
+        for res in results:
+            res.check()
+
+    @StateChange('started', 'loaded')
+    async def stop(self):
+        try:
+            await self._shutdown()
+        finally:
+            if self.gpu_count:
+                await self.o(self.gpus).release(self._current_path)
+
+    async def _shutdown(self):
+        try:
+            client = await self.qmp(timeout=0.)
+        except (OSError, SSHError) as e:
+            print(f'{self._current_path}: monitor unavailable, assuming stopped', e)
+            return
+        try:
+            shutdown = client.wait_event('SHUTDOWN')
+            await client.execute('system_powerdown')
+            try:
+                await wait_for(shield(shutdown), self.shutdown_timeout)
+            except TimeoutError:
+                print(f'{self._current_path}: no shutdown in {self.shutdown_timeout}s, quitting')
+                await client.execute('quit')
+        finally:
+            client.close()
+            self._qmp = None
 
 
 class DriveImage(ConfigObject):
@@ -64,29 +346,130 @@ class DriveImage(ConfigObject):
     size_mb: float = FloatField(default=1024.)
     mode: str = SelectField(values=('drive', 'cdrom-ro',))
     format: str = SelectField(values=('iso-ro', 'qcow2',))
+    cache: str = SelectField(values=('writeback', 'none', 'writethrough', 'directsync', 'unsafe'))
+    aio: str = SelectField(values=('threads', 'native', 'io_uring'))
+
+    def validate(self):
+        if self.aio == 'native' and self.cache not in ('none', 'directsync'):
+            raise ValueError(f'{self._current_path}: aio=native needs cache none or directsync')
+
+    def _store_digest(self) -> Optional[str]:
+        if self.base_img_path.startswith(STORE_PREFIX):
+            return self.base_img_path[len(STORE_PREFIX):]
+        return None
+
+    def _store_ref_name(self, env: 'Env') -> str:
+        return sha256(env.format_path(self.path).encode('utf-8')).hexdigest()[:16]
+
+    def exists_cmd(self, env: 'Env') -> str:
+        return f'ls "{env.format_path(self.path)}"'
+
+    def create_cmd(self, env: 'Env') -> Optional[str]:
+        """
+        :return: command creating missing drive, None when it cannot be created
+        """
+        if self.format != 'qcow2':
+            return None
+        path = env.format_path(self.path)
+        create_cmd = 'qemu-img create -f qcow2 '
+        if self.base_img_path:
+            digest = self._store_digest()
+            if digest is not None:
+                # ref link keeps base blob away from store eviction
+                store = self.o('$host').store
+                base_path = store.blob_path(digest)
+                create_cmd = f'{store.add_ref_cmd(digest, self._store_ref_name(env))} && {create_cmd}'
+            else:
+                base_path = env.format_path(self.base_img_path)
+            create_cmd += f'-o backing_file="{base_path}" "{path}"'
+        else:
+            create_cmd += f'"{path}" {self.size_mb / 1024.}G'
+        return create_cmd
 
     @StateChange('loaded', 'created')
     async def create(self):
         env = await self.get_env()
-        if self.format == 'qcow2':
-            cmd = f'( ls "{env.format_path(self.path)}" || qemu-img create -f qcow2 '
-            if self.base_img_path:
-                cmd += f'-o backing_file="{env.format_path(self.base_img_path)}" "{env.format_path(self.path)}"'
-            else:
-                cmd += f'"{env.format_path(self.path)}" {self.size_mb / 1024.}G'
-            cmd += ' )'
-        else:
-            cmd = f'ls "{env.format_path(self.path)}"'
-        await env.run_command(cmd)
+        for res in (await DriveImage._ensure_in_env(env, [self])).values():
+            res.check()
+
+    @staticmethod
+    async def _ensure_in_env(env: 'Env', drives: List['DriveImage']) -> Dict['DriveImage', CommandResult]:
+        """
+        Existence of drives is probed with cached command, only missing ones are created
+        :return: result of last command of every drive
+        """
+        probes = await env.run_batch([d.exists_cmd(env) for d in drives], idempotent=True)
+        results = dict(zip(drives, probes))
+        missing = [drive for drive, res in results.items() if res.exit_code != 0]
+        if missing:
+            created = await env.run_batch(
+                [d.create_cmd(env) or d.exists_cmd(env) for d in missing],
+                invalidates=[env.format_path(d.path) for d in missing]
+            )
+            results.update(zip(missing, created))
+        return results
+
+    @staticmethod
+    async def _create_in_env(env: 'Env', drives: List['DriveImage']):
+        results = await DriveImage._ensure_in_env(env, drives)
+        for drive, res in results.items():
+            if res.exit_code == 0:
+                drive._state = 'created'
+        for res in results.values():
+            res.check()
+
+    @staticmethod
+    async def _create_drives(drives: List['DriveImage']):
+        # one round trip per env instead of one per drive
+        by_env = defaultdict(list)
+        envs = await gather(*(drive.get_env() for drive in drives))
+        for drive, env in zip(drives, envs):
+            by_env[env].append(drive)
+        await gather(*(
+            DriveImage._create_in_env(env, env_drives)
+            for env, env_drives in by_env.items()
+        ))
+
+    @staticmethod
+    async def create_all(drives: Iterable['DriveImage']):
+        """
+        Create drives in batches, the batch is transition of its drives so concurrent
+        `withstate` callers and other vms wait for it instead of creating drives again
+        """
+        drives = [drive for drive in drives if drive._state == 'loaded' and drive._transition is None]
+        if not drives:
+            return
+        batch = ensure_future(DriveImage._create_drives(drives))
+        for drive in drives:
+            drive._transition = batch
+            batch.add_done_callback(drive._transition_done)
+        await shield(batch)
 
     @StateChange('created', 'loaded')
     async def remove(self):
         env = await self.get_env()
-        await env.run_command(f'rm -f {env.format_path(self.path)}')
+        path = env.format_path(self.path)
+        cmd = f'rm -f {path}'
+        digest = self._store_digest()
+        if digest is not None:
+            cmd += ' && ' + self.o('$host').store.remove_ref_cmd(digest, self._store_ref_name(env))
+        await env.run_command(cmd, invalidates=(path,))
 
-    async def get_mount_params(self):
+    async def get_path(self) -> str:
         env = await self.get_env()
-        if self.mode == 'cdrom-r':
-            return f'file={env.format_path(self.path)},media=cdrom,readonly'
-        elif self.mode == 'drive':
-            return f'file={env.format_path(self.path)},format={self.format},if=virtio,discard=unmap,detect-zeroes=unmap'
+        return env.format_path(self.path)
+
+    def mount_params(self, path: str, drive_id: Optional[str] = None) -> str:
+        """
+        :param drive_id: drive is attached by separate device with that id, otherwise with if=virtio
+        """
+        if self.mode == 'cdrom-ro':
+            return f'file={path},media=cdrom,readonly=on'
+        attach = f'if=none,id={drive_id}' if drive_id else 'if=virtio'
+        return (
+            f'file={path},format={self.format},{attach},cache={self.cache},aio={self.aio},'
+            'discard=unmap,detect-zeroes=unmap'
+        )
+
+    async def get_mount_params(self):
+        return self.mount_params(await self.get_path())